@@ -0,0 +1,103 @@
+import asyncio
+import json
+import random
+from typing import Awaitable, Callable
+
+import aiohttp.web
+
+
+class FakeHub:
+    def __init__(self, spawn_delay_secs: float = 0.0, error_rate: float = 0.0, server_address: str = "127.0.0.1") -> None:
+        super().__init__()
+        self.__spawn_delay_secs = spawn_delay_secs
+        self.__error_rate = error_rate
+        self.__server_address = server_address
+        self.__ready_events = dict[str, asyncio.Event]()
+        self.__runner: aiohttp.web.AppRunner | None = None
+        self.request_count = 0
+        self.injected_error_count = 0
+        self.spawn_count = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = aiohttp.web.Application(middlewares=[self.__inject_errors])
+        app.router.add_get("/hub/api/users", self.__list_users)
+        app.router.add_get("/hub/api/users/{name}", self.__get_user)
+        app.router.add_post("/hub/api/users/{name}", self.__get_user)
+        app.router.add_get("/hub/api/users/{name}/tokens/{token}", self.__get_token)
+        app.router.add_post("/hub/api/users/{name}/server", self.__start_server)
+        app.router.add_delete("/hub/api/users/{name}/server", self.__stop_server)
+        app.router.add_get("/hub/api/users/{name}/server/progress", self.__get_progress)
+        self.__runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        site = aiohttp.web.TCPSite(self.__runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    @aiohttp.web.middleware
+    async def __inject_errors(self, request: aiohttp.web.Request, handler: Callable[[aiohttp.web.Request], Awaitable[aiohttp.web.StreamResponse]]) -> aiohttp.web.StreamResponse:
+        self.request_count += 1
+        if random.random() < self.__error_rate:
+            self.injected_error_count += 1
+            return aiohttp.web.json_response({"status": 503, "message": "Injected error"}, status=503)
+        return await handler(request)
+
+    def __user_model(self, name: str) -> dict:
+        ready_event = self.__ready_events.get(name)
+        ready = ready_event is not None and ready_event.is_set()
+        return {
+            "name": name,
+            "server": self.__server_address if ready else None,
+            "pending": "spawn" if ready_event is not None and not ready else None,
+            "servers": {"": {"name": "", "ready": ready}} if ready_event is not None else {},
+        }
+
+    async def __get_user(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(self.__user_model(request.match_info["name"]))
+
+    async def __list_users(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        offset = int(request.query.get("offset", "0"))
+        limit = int(request.query.get("limit", "200"))
+        # Users only exist while their server runs or starts, so this is also the state=active listing
+        names = sorted(self.__ready_events.keys())
+        items = [self.__user_model(name) for name in names[offset:offset + limit]]
+        if request.headers.get("Accept") != "application/jupyterhub-pagination+json":
+            return aiohttp.web.json_response(items)
+        next_page = {"offset": offset + limit, "limit": limit} if offset + limit < len(names) else None
+        return aiohttp.web.json_response({"items": items, "_pagination": {"offset": offset, "limit": limit, "total": len(names), "next": next_page}})
+
+    async def __get_token(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response({"kind": "api_token", "user": request.match_info["name"]})
+
+    async def __start_server(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        name = request.match_info["name"]
+        if name in self.__ready_events:
+            return aiohttp.web.json_response({"status": 400, "message": f"{name} is already running"}, status=400)
+        self.spawn_count += 1
+        ready_event = asyncio.Event()
+        self.__ready_events[name] = ready_event
+        if self.__spawn_delay_secs <= 0:
+            ready_event.set()
+            return aiohttp.web.Response(status=201)
+        asyncio.get_running_loop().call_later(self.__spawn_delay_secs, ready_event.set)
+        return aiohttp.web.Response(status=202)
+
+    async def __stop_server(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        self.__ready_events.pop(request.match_info["name"], None)
+        return aiohttp.web.Response(status=204)
+
+    async def __get_progress(self, request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+        ready_event = self.__ready_events.get(request.match_info["name"])
+        if ready_event is None:
+            return aiohttp.web.json_response({"status": 404, "message": "No server"}, status=404)
+        response = aiohttp.web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(f"data: {json.dumps({'progress': 0, 'message': 'Server requested'})}\n\n".encode())
+        await ready_event.wait()
+        await response.write(f"data: {json.dumps({'progress': 100, 'ready': True, 'message': 'Server ready'})}\n\n".encode())
+        await response.write_eof()
+        return response
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Optional
+
+import asyncssh
+
+from fake_hub import FakeHub
+
+import better_jupyterhub_ssh
+
+
+# Random, so that compression is measured with incompressible payloads instead of best-case zeros
+_CHUNK = os.urandom(65536)
+
+
+class _InternalServer(asyncssh.SSHServer):
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return True
+
+
+async def _handle_process(process: asyncssh.SSHServerProcess) -> None:
+    command = (process.command or "").split()
+    if len(command) == 2 and command[0] == "stream":
+        remaining = int(command[1])
+        while remaining > 0:
+            process.stdout.write(_CHUNK[:remaining])
+            remaining -= len(_CHUNK)
+            await process.stdout.drain()
+    process.exit(0)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_bytes(pid: int) -> int:
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not available")
+
+
+def _percentiles(values: list[float]) -> dict[str, Any]:
+    if len(values) == 0:
+        return {"count": 0}
+    values = sorted(values)
+    def percentile(p: float) -> float:
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+    return {
+        "count": len(values),
+        "min": values[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+async def _wait_for_port(port: int, timeout_secs: float) -> None:
+    deadline = time.monotonic() + timeout_secs
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def _connect(port: int, username: str, **options: Any) -> asyncssh.SSHClientConnection:
+    return await asyncssh.connect("127.0.0.1", port, username=username, password="benchmark-token", known_hosts=None, **options)
+
+
+async def _measure_login(port: int, username: str) -> Optional[float]:
+    started_at = time.perf_counter()
+    try:
+        conn = await _connect(port, username)
+    except (OSError, asyncssh.Error):
+        return None
+    elapsed_secs = time.perf_counter() - started_at
+    conn.close()
+    await conn.wait_closed()
+    return elapsed_secs
+
+
+async def _bench_login_latency(port: int, concurrency: int) -> dict[str, Any]:
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(_measure_login(port, f"bench-{concurrency}-{i}") for i in range(concurrency)))
+    wall_secs = time.perf_counter() - started_at
+    latencies = [result for result in results if result is not None]
+    return {**_percentiles(latencies), "failures": len(results) - len(latencies), "wall_secs": wall_secs}
+
+
+async def _bench_stream_throughput(port: int, size: int, **options: Any) -> dict[str, Any]:
+    async with await _connect(port, "bench-stream", **options) as conn:
+        process = await conn.create_process(f"stream {size}", encoding=None)
+        received = 0
+        started_at = time.perf_counter()
+        while True:
+            data = await process.stdout.read(1 << 20)
+            if not data:
+                break
+            received += len(data)
+        elapsed_secs = time.perf_counter() - started_at
+        await process.wait()
+    return {"bytes": received, "secs": elapsed_secs, "mib_per_sec": received / elapsed_secs / (1 << 20)}
+
+
+async def _bench_sftp_throughput(port: int, remote_path: str) -> dict[str, Any]:
+    async with await _connect(port, "bench-sftp") as conn:
+        async with conn.start_sftp_client() as sftp:
+            started_at = time.perf_counter()
+            await sftp.get(remote_path, os.devnull)
+            elapsed_secs = time.perf_counter() - started_at
+    size = os.path.getsize(remote_path)
+    return {"bytes": size, "secs": elapsed_secs, "mib_per_sec": size / elapsed_secs / (1 << 20)}
+
+
+async def _bench_memory(port: int, proxy_pid: int, connection_count: int) -> dict[str, Any]:
+    await asyncio.sleep(1.0)
+    rss_before = _rss_bytes(proxy_pid)
+    connections = await asyncio.gather(*(_connect(port, f"bench-memory-{i}") for i in range(connection_count)))
+    await asyncio.sleep(1.0)
+    rss_after = _rss_bytes(proxy_pid)
+    for conn in connections:
+        conn.close()
+    for conn in connections:
+        await conn.wait_closed()
+    return {
+        "connections": connection_count,
+        "rss_before_bytes": rss_before,
+        "rss_after_bytes": rss_after,
+        "rss_per_connection_bytes": (rss_after - rss_before) / connection_count,
+    }
+
+
+async def _run(args: argparse.Namespace) -> dict[str, Any]:
+    work_dir = Path(tempfile.mkdtemp(prefix="jupyter_ssh_proxy_bench_"))
+    host_key_dir = work_dir / "host_keys"
+    host_key_dir.mkdir()
+    asyncssh.generate_private_key("ssh-ed25519").write_private_key(str(host_key_dir / "ssh_host_ed25519_key"))
+    internal_host_key = asyncssh.generate_private_key("ssh-ed25519")
+    sftp_file = work_dir / "sftp_payload"
+    with open(sftp_file, "wb") as file:
+        for _ in range(args.sftp_mib * (1 << 20) // len(_CHUNK)):
+            file.write(_CHUNK)
+
+    internal_server = await asyncssh.create_server(
+        _InternalServer,
+        host="127.0.0.1",
+        port=0,
+        server_host_keys=[internal_host_key],
+        process_factory=_handle_process,
+        sftp_factory=True,
+        encoding=None,
+    )
+    internal_port = internal_server.sockets[0].getsockname()[1]
+    known_hosts_file = work_dir / "known_hosts"
+    known_hosts_file.write_text(f"[127.0.0.1]:{internal_port} {internal_host_key.export_public_key().decode()}")
+
+    fake_hub = FakeHub(spawn_delay_secs=args.spawn_delay, error_rate=args.hub_error_rate)
+    hub_url = await fake_hub.start()
+
+    proxy_log = open(args.proxy_log, "w") if args.proxy_log is not None else subprocess.DEVNULL
+    def start_proxy(proxy_port: int, *proxy_args: str) -> subprocess.Popen:
+        return subprocess.Popen(
+            [
+                sys.executable, "-m", "better_jupyterhub_ssh.main", hub_url,
+                "-p", str(proxy_port),
+                "-k", str(host_key_dir),
+                "--internal-port", str(internal_port),
+                "--internal-known-hosts", str(known_hosts_file),
+                *args.proxy_args,
+                *proxy_args,
+            ],
+            stdout=proxy_log,
+            stderr=proxy_log,
+        )
+
+    proxy_port = _free_port()
+    proxy = start_proxy(proxy_port)
+    results: dict[str, Any] = {
+        "meta": {
+            "version": better_jupyterhub_ssh.VERSION,
+            "asyncssh_version": asyncssh.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+            "spawn_delay_secs": args.spawn_delay,
+            "hub_error_rate": args.hub_error_rate,
+            "proxy_args": args.proxy_args,
+        },
+    }
+    try:
+        await _wait_for_port(proxy_port, 30.0)
+        results["login_latency_secs"] = {}
+        for concurrency in args.concurrency:
+            results["login_latency_secs"][str(concurrency)] = await _bench_login_latency(proxy_port, concurrency)
+        results["stream_throughput"] = await _bench_stream_throughput(proxy_port, args.stream_mib * (1 << 20))
+        results["sftp_throughput"] = await _bench_sftp_throughput(proxy_port, str(sftp_file))
+        results["memory"] = await _bench_memory(proxy_port, proxy.pid, args.memory_connections)
+        results["stream_throughput_per_cipher"] = {}
+        for cipher in args.ciphers:
+            # Same cipher on both legs, without compression, to isolate the re-encryption cost
+            cipher_proxy_port = _free_port()
+            cipher_proxy = start_proxy(
+                cipher_proxy_port,
+                "--client-encryption-algs", cipher,
+                "--client-compression-algs", "none",
+                "--internal-encryption-algs", cipher,
+                "--internal-compression-algs", "none",
+            )
+            try:
+                await _wait_for_port(cipher_proxy_port, 30.0)
+                results["stream_throughput_per_cipher"][cipher] = await _bench_stream_throughput(
+                    cipher_proxy_port,
+                    args.stream_mib * (1 << 20),
+                    encryption_algs=[cipher],
+                    compression_algs=["none"],
+                )
+            finally:
+                cipher_proxy.terminate()
+                cipher_proxy.wait()
+        results["hub"] = {
+            "requests": fake_hub.request_count,
+            "injected_errors": fake_hub.injected_error_count,
+            "spawns": fake_hub.spawn_count,
+        }
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        await fake_hub.stop()
+        internal_server.close()
+        sftp_file.unlink()
+        if args.proxy_log is not None:
+            proxy_log.close()  # type: ignore
+    return results
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Benchmark the jupyter hub SSH proxy against a fake hub and a local internal SSH server")
+    arg_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 100, 1000])
+    arg_parser.add_argument("--spawn-delay", type=float, default=0.0)
+    arg_parser.add_argument("--hub-error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--stream-mib", type=int, default=256)
+    arg_parser.add_argument("--sftp-mib", type=int, default=64)
+    arg_parser.add_argument("--memory-connections", type=int, default=200)
+    arg_parser.add_argument("--ciphers", type=str, nargs="*", default=["aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "chacha20-poly1305@openssh.com", "aes128-ctr"])
+    arg_parser.add_argument("--proxy-log", type=str, default=None)
+    arg_parser.add_argument("-o", "--output", type=str, default=None)
+    arg_parser.add_argument("proxy_args", nargs=argparse.REMAINDER, help="Additional arguments passed to the proxy (after --)")
+    args = arg_parser.parse_args()
+    if len(args.proxy_args) > 0 and args.proxy_args[0] == "--":
+        args.proxy_args = args.proxy_args[1:]
+
+    results = asyncio.run(_run(args))
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
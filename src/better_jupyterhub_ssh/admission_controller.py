@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import logging
+import time
+from typing import AsyncIterator
+
+import asyncssh
+
+from better_jupyterhub_ssh.metrics import REGISTRY
+
+
+_IN_FLIGHT_LOGINS = REGISTRY.gauge("jupyter_ssh_proxy_in_flight_logins", "Number of logins currently being processed")
+_QUEUED_LOGINS = REGISTRY.gauge("jupyter_ssh_proxy_queued_logins", "Number of logins waiting for admission")
+_QUEUE_WAIT_SECONDS = REGISTRY.histogram("jupyter_ssh_proxy_login_queue_wait_seconds", "Time logins spent waiting for admission")
+_REJECTED_QUEUE_FULL = REGISTRY.counter("jupyter_ssh_proxy_rejected_logins_total", "Number of logins rejected by admission control", reason="queue_full")
+_REJECTED_TIMEOUT = REGISTRY.counter("jupyter_ssh_proxy_rejected_logins_total", "Number of logins rejected by admission control", reason="timeout")
+
+
+class _Waiter:
+    __slots__ = ("username", "future")
+
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+
+class AdmissionController:
+    def __init__(self, max_logins: int = 0, max_logins_per_user: int = 0, max_queue_size: int = 1024, queue_timeout_secs: float = 30.0) -> None:
+        super().__init__()
+        self.__max_logins = max_logins
+        self.__max_logins_per_user = max_logins_per_user
+        self.__max_queue_size = max_queue_size
+        self.__queue_timeout_secs = queue_timeout_secs
+        self.__in_flight = 0
+        self.__in_flight_per_user = dict[str, int]()
+        self.__queue = deque[_Waiter]()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.__queue)
+
+    @asynccontextmanager
+    async def admit(self, connection_id: str, username: str) -> AsyncIterator[None]:
+        await self.__acquire(connection_id, username)
+        try:
+            yield
+        finally:
+            self.__release(username)
+
+    def __admissible(self, username: str) -> bool:
+        return (
+            (self.__max_logins <= 0 or self.__in_flight < self.__max_logins)
+            and (self.__max_logins_per_user <= 0 or self.__in_flight_per_user.get(username, 0) < self.__max_logins_per_user)
+        )
+
+    def __take_slot(self, username: str) -> None:
+        self.__in_flight += 1
+        self.__in_flight_per_user[username] = self.__in_flight_per_user.get(username, 0) + 1
+        _IN_FLIGHT_LOGINS.value += 1
+
+    async def __acquire(self, connection_id: str, username: str) -> None:
+        # Queued waiters are never admissible (they are admitted on every release), so this keeps the FIFO order
+        if self.__admissible(username):
+            self.__take_slot(username)
+            _QUEUE_WAIT_SECONDS.observe(0.0)
+            return
+        if len(self.__queue) >= self.__max_queue_size:
+            _REJECTED_QUEUE_FULL.value += 1
+            logging.getLogger(__name__).warning("[%s] Login rejected, queue is full", connection_id)
+            raise asyncssh.DisconnectError(asyncssh.DISC_TOO_MANY_CONNECTIONS, "Too many concurrent logins, please try again later", "en-US")
+        waiter = _Waiter(username)
+        self.__queue.append(waiter)
+        _QUEUED_LOGINS.value += 1
+        logging.getLogger(__name__).debug("[%s] Login queued at position %s", connection_id, len(self.__queue))
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.__queue_timeout_secs)
+        except BaseException as exc:
+            if waiter.future.done():
+                # Admitted concurrently with the timeout or cancellation, so give the slot back
+                self.__release(username)
+            else:
+                waiter.future.cancel()
+                self.__queue.remove(waiter)
+                _QUEUED_LOGINS.value -= 1
+            if isinstance(exc, asyncio.TimeoutError):
+                _REJECTED_TIMEOUT.value += 1
+                logging.getLogger(__name__).warning("[%s] Login rejected, timed out waiting for admission", connection_id)
+                raise asyncssh.DisconnectError(asyncssh.DISC_TOO_MANY_CONNECTIONS, "Too many concurrent logins, please try again later", "en-US")
+            raise
+        _QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started_at)
+
+    def __release(self, username: str) -> None:
+        self.__in_flight -= 1
+        _IN_FLIGHT_LOGINS.value -= 1
+        remaining = self.__in_flight_per_user[username] - 1
+        if remaining == 0:
+            del self.__in_flight_per_user[username]
+        else:
+            self.__in_flight_per_user[username] = remaining
+        self.__admit_waiters()
+
+    def __admit_waiters(self) -> None:
+        # FIFO among the waiters that can be admitted, so users at their own limit do not block everyone else
+        for waiter in list(self.__queue):
+            if self.__max_logins > 0 and self.__in_flight >= self.__max_logins:
+                break
+            if self.__admissible(waiter.username):
+                self.__queue.remove(waiter)
+                _QUEUED_LOGINS.value -= 1
+                self.__take_slot(waiter.username)
+                waiter.future.set_result(None)
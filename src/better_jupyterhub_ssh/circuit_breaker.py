@@ -0,0 +1,48 @@
+import time
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_secs: float = 30.0) -> None:
+        super().__init__()
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout_secs = reset_timeout_secs
+        self.__consecutive_failures = 0
+        self.__opened_at = 0.0
+        self.__state = CircuitBreaker.CLOSED
+        self.__trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        return self.__state
+
+    def allow_request(self) -> bool:
+        if self.__state == CircuitBreaker.CLOSED:
+            return True
+        if self.__state == CircuitBreaker.OPEN:
+            if time.monotonic() - self.__opened_at < self.__reset_timeout_secs:
+                return False
+            self.__state = CircuitBreaker.HALF_OPEN
+        # Half open: let a single trial request through, its outcome decides whether to close again
+        if self.__trial_in_progress:
+            return False
+        self.__trial_in_progress = True
+        return True
+
+    def record_success(self) -> None:
+        self.__consecutive_failures = 0
+        self.__trial_in_progress = False
+        self.__state = CircuitBreaker.CLOSED
+
+    def record_failure(self) -> None:
+        self.__consecutive_failures += 1
+        self.__trial_in_progress = False
+        if self.__state == CircuitBreaker.HALF_OPEN or (self.__failure_threshold > 0 and self.__consecutive_failures >= self.__failure_threshold):
+            self.__state = CircuitBreaker.OPEN
+            self.__opened_at = time.monotonic()
+
+    def record_abandoned(self) -> None:
+        self.__trial_in_progress = False
@@ -0,0 +1,47 @@
+from typing import Any, Tuple, TypeVar
+
+from better_jupyterhub_ssh.directory_service import DirectoryService
+from better_jupyterhub_ssh.single_flight import SingleFlight
+
+
+T = TypeVar("T")
+class CoalescingDirectoryService(DirectoryService[T]):
+    def __init__(self, directory_service: DirectoryService[T]) -> None:
+        super().__init__()
+        self.__directory_service = directory_service
+        self.__validate_auth_calls = SingleFlight[Tuple[str, Any], bool]()
+        self.__forwarding_args_calls = SingleFlight[Tuple[str, Any], Tuple[str, dict[str,Any]]]()
+        self.__start_server_calls = SingleFlight[Tuple[str, Any], None]()
+
+    async def validate_auth(self, connection_id: str, username: str, auth_data: T) -> bool:
+        return await self.__validate_auth_calls.run(
+            (username, auth_data),
+            lambda: self.__directory_service.validate_auth(connection_id, username, auth_data),
+        )
+
+    async def get_forwarding_args(self, connection_id: str, username: str, auth_data: T) -> Tuple[str, dict[str,Any]]:
+        # Keyed by credentials as well, since the forwarding arguments may contain them
+        host, kwargs = await self.__forwarding_args_calls.run(
+            (username, auth_data),
+            lambda: self.__directory_service.get_forwarding_args(connection_id, username, auth_data),
+        )
+        return host, dict(kwargs)
+
+    async def start_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        # Keyed by credentials as well, spawns may be started speculatively before the credentials are validated
+        await self.__start_server_calls.run(
+            (username, auth_data),
+            lambda: self.__directory_service.start_server(connection_id, username, auth_data),
+        )
+
+    async def stop_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        await self.__directory_service.stop_server(connection_id, username, auth_data)
+
+    async def release_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        await self.__directory_service.release_server(connection_id, username, auth_data)
+
+    def report_unreachable(self, connection_id: str, username: str) -> None:
+        self.__directory_service.report_unreachable(connection_id, username)
+
+    async def finalize(self) -> None:
+        await self.__directory_service.finalize()
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import hashlib
+import time
+from typing import Optional, Tuple
+
+from better_jupyterhub_ssh.metrics import REGISTRY
+
+
+_AUTH_CACHE_HITS = REGISTRY.counter("jupyter_ssh_proxy_auth_cache_lookups_total", "Number of lookups in the authentication cache", result="hit")
+_AUTH_CACHE_MISSES = REGISTRY.counter("jupyter_ssh_proxy_auth_cache_lookups_total", "Number of lookups in the authentication cache", result="miss")
+_AUTH_CACHE_EVICTIONS = REGISTRY.counter("jupyter_ssh_proxy_auth_cache_evictions_total", "Number of authentication results evicted from the full cache")
+_AUTH_CACHE_ENTRIES = REGISTRY.gauge("jupyter_ssh_proxy_auth_cache_entries", "Number of authentication results in the cache")
+
+
+class CredentialCache:
+    def __init__(self, max_size: int = 1024, ttl_secs: float = 300.0, negative_ttl_secs: float = 10.0) -> None:
+        super().__init__()
+        self.__max_size = max_size
+        self.__ttl_secs = ttl_secs
+        self.__negative_ttl_secs = negative_ttl_secs
+        self.__entries = OrderedDict[Tuple[str, str], Tuple[bool, float]]()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def __key(username: str, auth_data: str) -> Tuple[str, str]:
+        # Only a digest of the token is kept in memory
+        return username, hashlib.sha256(auth_data.encode("utf-8")).hexdigest()
+
+    def get(self, username: str, auth_data: str) -> Optional[bool]:
+        key = self.__key(username, auth_data)
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            _AUTH_CACHE_MISSES.value += 1
+            return None
+        valid, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.__entries[key]
+            _AUTH_CACHE_ENTRIES.value -= 1
+            self.misses += 1
+            _AUTH_CACHE_MISSES.value += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        _AUTH_CACHE_HITS.value += 1
+        return valid
+
+    def put(self, username: str, auth_data: str, valid: bool) -> None:
+        ttl_secs = self.__ttl_secs if valid else self.__negative_ttl_secs
+        if self.__max_size <= 0 or ttl_secs <= 0:
+            return
+        key = self.__key(username, auth_data)
+        if key not in self.__entries:
+            _AUTH_CACHE_ENTRIES.value += 1
+        self.__entries[key] = (valid, time.monotonic() + ttl_secs)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+            _AUTH_CACHE_ENTRIES.value -= 1
+            self.evictions += 1
+            _AUTH_CACHE_EVICTIONS.value += 1
+
+    def invalidate(self, username: str, auth_data: str) -> None:
+        if self.__entries.pop(self.__key(username, auth_data), None) is not None:
+            _AUTH_CACHE_ENTRIES.value -= 1
+
+    def clear(self) -> None:
+        _AUTH_CACHE_ENTRIES.value -= len(self.__entries)
+        self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
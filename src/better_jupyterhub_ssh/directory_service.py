@@ -13,9 +13,20 @@ class DirectoryService(ABC, Generic[T]):
         ...
 
     @abstractmethod
-    async def start_server(self, connection_id: str, username: str, auth_data: T, retry_secs: int = 10) -> None:
+    async def start_server(self, connection_id: str, username: str, auth_data: T) -> None:
         ...
     
     @abstractmethod
     async def stop_server(self, connection_id: str, username: str, auth_data: T) -> None:
-        ...
\ No newline at end of file
+        ...
+
+    async def release_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        # Gives back a server started for credentials that turned out to be invalid
+        await self.stop_server(connection_id, username, auth_data)
+
+    def report_unreachable(self, connection_id: str, username: str) -> None:
+        # Called when the address returned by get_forwarding_args could not be connected to
+        pass
+
+    async def finalize(self) -> None:
+        pass
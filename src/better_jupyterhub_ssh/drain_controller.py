@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+import asyncssh
+
+from better_jupyterhub_ssh.metrics import REGISTRY
+
+
+_DRAINING = REGISTRY.gauge("jupyter_ssh_proxy_draining", "Whether the proxy stopped accepting connections and waits for the open ones to finish")
+_DRAIN_DISCONNECTS = REGISTRY.counter("jupyter_ssh_proxy_drain_disconnects_total", "Number of connections closed because they outlived the drain deadline")
+
+
+class DrainController:
+    def __init__(self) -> None:
+        super().__init__()
+        self.__connections = set[asyncssh.SSHServerConnection]()
+        self.__idle_event = asyncio.Event()
+        self.__idle_event.set()
+        self.__draining = False
+
+    @property
+    def draining(self) -> bool:
+        return self.__draining
+
+    @property
+    def connection_count(self) -> int:
+        return len(self.__connections)
+
+    def register(self, conn: asyncssh.SSHServerConnection) -> None:
+        self.__connections.add(conn)
+        self.__idle_event.clear()
+
+    def unregister(self, conn: asyncssh.SSHServerConnection) -> None:
+        self.__connections.discard(conn)
+        if len(self.__connections) == 0:
+            self.__idle_event.set()
+
+    async def drain(self, deadline_secs: float, close_timeout_secs: float = 5.0) -> None:
+        self.__draining = True
+        _DRAINING.set(1)
+        logging.getLogger(__name__).info("Draining %s connections, deadline in %ss", len(self.__connections), deadline_secs)
+        try:
+            await asyncio.wait_for(self.__idle_event.wait(), deadline_secs)
+        except asyncio.TimeoutError:
+            logging.getLogger(__name__).warning("Drain deadline exceeded, disconnecting %s remaining connections", len(self.__connections))
+            self.disconnect_all()
+            try:
+                await asyncio.wait_for(self.__idle_event.wait(), close_timeout_secs)
+            except asyncio.TimeoutError:
+                logging.getLogger(__name__).error("%s connections did not close in time", len(self.__connections))
+        logging.getLogger(__name__).info("Drain completed")
+
+    def disconnect_all(self) -> None:
+        for conn in list(self.__connections):
+            _DRAIN_DISCONNECTS.value += 1
+            conn.disconnect(asyncssh.DISC_BY_APPLICATION, "Proxy is shutting down, please reconnect", "en-US")
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+import time
+from typing import Tuple
+
+
+class FailedLoginLimiter:
+    def __init__(self, max_failures: int = 3, window_secs: float = 300.0, max_users: int = 10000) -> None:
+        super().__init__()
+        self.__max_failures = max_failures
+        self.__window_secs = window_secs
+        self.__max_users = max_users
+        self.__failures = OrderedDict[str, Tuple[int, float]]()
+
+    def allows(self, username: str) -> bool:
+        entry = self.__failures.get(username)
+        if entry is None:
+            return True
+        failures, window_started_at = entry
+        if time.monotonic() - window_started_at >= self.__window_secs:
+            del self.__failures[username]
+            return True
+        return failures < self.__max_failures
+
+    def record_failure(self, username: str) -> None:
+        now = time.monotonic()
+        failures, window_started_at = self.__failures.get(username, (0, now))
+        if now - window_started_at >= self.__window_secs:
+            failures, window_started_at = 0, now
+        self.__failures[username] = (failures + 1, window_started_at)
+        self.__failures.move_to_end(username)
+        # Bounded, so that failed logins for arbitrary usernames cannot exhaust memory
+        while len(self.__failures) > self.__max_users:
+            self.__failures.popitem(last=False)
+
+    def record_success(self, username: str) -> None:
+        self.__failures.pop(username, None)
+
+    def __len__(self) -> int:
+        return len(self.__failures)
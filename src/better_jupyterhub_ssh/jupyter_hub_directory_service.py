@@ -1,80 +1,370 @@
 import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
+import json
 import logging
-from typing import Any, Tuple
+import random
+import time
+from typing import Any, AsyncIterator, Optional, Tuple
 
 import aiohttp
 import asyncssh
 
+from better_jupyterhub_ssh.circuit_breaker import CircuitBreaker
+from better_jupyterhub_ssh.credential_cache import CredentialCache
 from better_jupyterhub_ssh.directory_service import DirectoryService
+from better_jupyterhub_ssh.metrics import REGISTRY, Counter, Histogram
+from better_jupyterhub_ssh.server_index import ServerEntry, ServerIndex
+
+
+_MAX_SPAWN_POLL_INTERVAL_SECS = 5.0
+_USER_LIST_PAGE_SIZE = 200
+
+
+_HUB_CIRCUIT_OPEN = REGISTRY.gauge("jupyter_ssh_proxy_hub_circuit_open", "Whether requests to the jupyter hub are currently short-circuited")
+_SERVER_INDEX_HITS = REGISTRY.counter("jupyter_ssh_proxy_server_index_lookups_total", "Number of user server lookups in the background-refreshed server index", result="hit")
+_SERVER_INDEX_MISSES = REGISTRY.counter("jupyter_ssh_proxy_server_index_lookups_total", "Number of user server lookups in the background-refreshed server index", result="miss")
+_SERVER_INDEX_USERS = REGISTRY.gauge("jupyter_ssh_proxy_server_index_users", "Number of users in the background-refreshed server index")
+_SERVER_INDEX_REFRESH_ERRORS = REGISTRY.counter("jupyter_ssh_proxy_server_index_refresh_errors_total", "Number of failed refreshes of the server index")
+
+
+class HubUnavailableError(aiohttp.ClientError):
+    pass
+
+
+def _hub_request_histogram(operation: str) -> Histogram:
+    return REGISTRY.histogram("jupyter_ssh_proxy_hub_request_seconds", "Latency of jupyter hub API requests until the response headers arrived", operation=operation)
+
+
+def _hub_request_error_counter(operation: str) -> Counter:
+    return REGISTRY.counter("jupyter_ssh_proxy_hub_request_errors_total", "Number of failed or 5xx jupyter hub API requests", operation=operation)
 
 
 # TODO Integration tests
 class JupyterHubDirectoryService(DirectoryService[str]):
-    def __init__(self, hub_url: str) -> None:
+    def __init__(
+        self,
+        hub_url: str,
+        auth_cache_size: int = 1024,
+        auth_cache_ttl_secs: float = 300.0,
+        auth_cache_negative_ttl_secs: float = 10.0,
+        spawn_timeout_secs: float = 300.0,
+        spawn_progress_stream: bool = True,
+        spawn_poll_interval_secs: float = 1.0,
+        internal_connect_options: Optional[dict[str, Any]] = None,
+        max_connections: int = 100,
+        keepalive_timeout_secs: float = 30.0,
+        connect_timeout_secs: float = 5.0,
+        request_timeout_secs: float = 30.0,
+        total_request_timeout_secs: float = 60.0,
+        retries: int = 2,
+        retry_backoff_secs: float = 0.2,
+        circuit_failure_threshold: int = 5,
+        circuit_reset_timeout_secs: float = 30.0,
+        server_index_token: Optional[str] = None,
+        server_index_refresh_interval_secs: float = 10.0,
+        server_index_max_age_secs: float = 30.0,
+    ) -> None:
         super().__init__()
-        self.__session = aiohttp.ClientSession(f"{hub_url}")
+        self.__hub_url = hub_url
+        self.__session: aiohttp.ClientSession | None = None
+        self.__max_connections = max_connections
+        self.__keepalive_timeout_secs = keepalive_timeout_secs
+        self.__connect_timeout_secs = connect_timeout_secs
+        self.__request_timeout_secs = request_timeout_secs
+        self.__total_request_timeout_secs = total_request_timeout_secs
+        self.__retries = retries
+        self.__retry_backoff_secs = retry_backoff_secs
+        self.__circuit_breaker = CircuitBreaker(circuit_failure_threshold, circuit_reset_timeout_secs)
+        self.__auth_cache = CredentialCache(auth_cache_size, auth_cache_ttl_secs, auth_cache_negative_ttl_secs)
+        self.__spawn_timeout_secs = spawn_timeout_secs
+        self.__spawn_progress_stream = spawn_progress_stream
+        self.__spawn_poll_interval_secs = spawn_poll_interval_secs
+        self.__internal_connect_options = internal_connect_options or {}
+        self.__server_index_token = server_index_token
+        self.__server_index_refresh_interval_secs = server_index_refresh_interval_secs
+        self.__server_index = ServerIndex(server_index_max_age_secs) if server_index_token is not None else None
+        self.__server_index_task: asyncio.Task[None] | None = None
 
-    async def validate_auth(self, connection_id: str, username: str, auth_data: str) -> bool:
-        try:
-            async with self.__session.get(f"/hub/api/users/{username}", headers={"Authentication": f"token {auth_data}"}) as response:
+    def __get_session(self) -> aiohttp.ClientSession:
+        # Created lazily, so that the connector is bound to the event loop actually serving requests
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                self.__hub_url,
+                connector=aiohttp.TCPConnector(limit=self.__max_connections, keepalive_timeout=self.__keepalive_timeout_secs),
+                timeout=aiohttp.ClientTimeout(total=self.__request_timeout_secs, sock_connect=self.__connect_timeout_secs),
+            )
+        return self.__session
+
+    def __slow_operation_timeout(self) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=self.__spawn_timeout_secs, sock_connect=self.__connect_timeout_secs)
+
+    @asynccontextmanager
+    async def __request(self, operation: str, method: str, path: str, auth_data: str, headers: Optional[dict[str, str]] = None, timeout: Optional[aiohttp.ClientTimeout] = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        # Only idempotent requests are retried
+        attempts = 1 + (self.__retries if method == "GET" else 0)
+        # The retries share one deadline, so that a lookup cannot take the request timeout once per attempt
+        deadline = time.monotonic() + self.__total_request_timeout_secs
+        for attempt in range(attempts):
+            if attempt > 0:
+                await asyncio.sleep(min(self.__retry_backoff_secs * 2 ** (attempt - 1) * random.uniform(0.5, 1.5), max(0.0, deadline - time.monotonic())))
+            if not self.__circuit_breaker.allow_request():
+                _hub_request_error_counter(operation).value += 1
+                raise HubUnavailableError(f"Circuit breaker is {self.__circuit_breaker.state}")
+            started_at = time.perf_counter()
+            try:
+                request = self.__get_session().request(method, path, headers={"Authentication": f"token {auth_data}", **(headers or {})}, **({"timeout": timeout} if timeout is not None else {}))
+                response = await (asyncio.wait_for(request, max(0.0, deadline - time.monotonic())) if attempts > 1 else request)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                _hub_request_error_counter(operation).value += 1
+                self.__circuit_breaker.record_failure()
+                _HUB_CIRCUIT_OPEN.set(int(self.__circuit_breaker.state == CircuitBreaker.OPEN))
+                if attempt + 1 < attempts and time.monotonic() < deadline:
+                    continue
+                raise
+            except BaseException:
+                self.__circuit_breaker.record_abandoned()
+                raise
+            _hub_request_histogram(operation).observe(time.perf_counter() - started_at)
+            if response.status >= 500:
+                _hub_request_error_counter(operation).value += 1
+                self.__circuit_breaker.record_failure()
+                if attempt + 1 < attempts and time.monotonic() < deadline:
+                    response.release()
+                    continue
+            else:
+                self.__circuit_breaker.record_success()
+            _HUB_CIRCUIT_OPEN.set(int(self.__circuit_breaker.state == CircuitBreaker.OPEN))
+            try:
+                yield response
+            finally:
+                response.release()
+            return
+
+    @property
+    def auth_cache(self) -> CredentialCache:
+        return self.__auth_cache
+
+    @property
+    def server_index(self) -> Optional[ServerIndex]:
+        return self.__server_index
+
+    def __lookup_server(self, username: str) -> Optional[ServerEntry]:
+        if self.__server_index is None:
+            return None
+        # Started lazily, so that the refresh task runs on the event loop actually serving requests
+        if self.__server_index_task is None:
+            self.__server_index_task = asyncio.ensure_future(self.__refresh_server_index())
+        entry = self.__server_index.get(username)
+        if entry is None:
+            _SERVER_INDEX_MISSES.value += 1
+        else:
+            _SERVER_INDEX_HITS.value += 1
+        return entry
+
+    async def __refresh_server_index(self) -> None:
+        assert self.__server_index is not None
+        while True:
+            started_at = time.monotonic()
+            try:
+                self.__server_index.replace(await self.__list_users(), started_at)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+                _SERVER_INDEX_REFRESH_ERRORS.value += 1
+                logging.getLogger(__name__).warning("Failed to refresh the server index", exc_info=True)
+            except Exception:
+                # The task is never restarted, so unexpected errors must not end it and leave the index stale
+                _SERVER_INDEX_REFRESH_ERRORS.value += 1
+                logging.getLogger(__name__).error("Unexpected error while refreshing the server index", exc_info=True)
+            else:
+                _SERVER_INDEX_USERS.set(len(self.__server_index))
+            await asyncio.sleep(self.__server_index_refresh_interval_secs)
+
+    async def __list_users(self) -> list[dict[str, Any]]:
+        assert self.__server_index_token is not None
+        users = list[dict[str, Any]]()
+        offset = 0
+        while True:
+            async with self.__request(
+                "list_users",
+                "GET",
+                # Only users with a running or starting server, users missing from the index are looked up at the hub
+                f"/hub/api/users?state=active&offset={offset}&limit={_USER_LIST_PAGE_SIZE}",
+                self.__server_index_token,
+                {"Accept": "application/jupyterhub-pagination+json"},
+            ) as response:
                 if response.status != 200:
-                    logging.getLogger(__name__).info(f"[{connection_id}] Unknown user")
-                    return False
-        except BaseException:
-            logging.getLogger(__name__).error(f"[{connection_id}] Failed to connect to jupyter hub")
-            raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to connect to jupyter hub", "en-US")
+                    raise HubUnavailableError(f"Jupyter hub responded with status {response.status}")
+                page = await response.json()
+            # Hubs without pagination support return all users as plain list
+            if isinstance(page, list):
+                return page
+            users.extend(page["items"])
+            next_page = page.get("_pagination", {}).get("next")
+            if next_page is None:
+                return users
+            offset = next_page["offset"]
+
+    async def validate_auth(self, connection_id: str, username: str, auth_data: str) -> bool:
+        cached = self.__auth_cache.get(username, auth_data)
+        if cached is not None:
+            logging.getLogger(__name__).debug("[%s] Using cached authentication result", connection_id)
+            if cached:
+                logging.getLogger(__name__).info('[%s] User "%s" successfully logged in', connection_id, username)
+            return cached
+        valid = await self.__validate_auth(connection_id, username, auth_data)
+        self.__auth_cache.put(username, auth_data, valid)
+        return valid
+
+    async def __validate_auth(self, connection_id: str, username: str, auth_data: str) -> bool:
+        get_user_status = partial(self.__get_status, "get_user", f"/hub/api/users/{username}", auth_data)
+        get_token_status = partial(self.__get_status, "get_token", f"/hub/api/users/{username}/tokens/{auth_data}", auth_data)
         try:
-            async with self.__session.get(f"/hub/api/users/{username}/tokens/{auth_data}", headers={"Authentication": f"token {auth_data}"}) as response:
-                if response.status != 200:
-                    logging.getLogger(__name__).info(f"[{connection_id}] Invalid token")
-                    return False
-        except BaseException:
-            logging.getLogger(__name__).exception(f"[{connection_id}] Failed to connect to jupyter hub")
+            if self.__circuit_breaker.state == CircuitBreaker.CLOSED:
+                # Both lookups are independent, so they are issued concurrently
+                user_status, token_status = await asyncio.gather(get_user_status(), get_token_status())
+            else:
+                # A recovering circuit breaker only lets a single trial request through, the second lookup is sent once it closed again
+                user_status = await get_user_status()
+                token_status = await get_token_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.getLogger(__name__).error("[%s] Failed to connect to jupyter hub", connection_id)
             raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to connect to jupyter hub", "en-US")
-        logging.getLogger(__name__).info(f'[{connection_id}] User "{username}" successfully logged in')
+        if user_status != 200:
+            logging.getLogger(__name__).info("[%s] Unknown user", connection_id)
+            return False
+        if token_status != 200:
+            logging.getLogger(__name__).info("[%s] Invalid token", connection_id)
+            return False
+        logging.getLogger(__name__).info('[%s] User "%s" successfully logged in', connection_id, username)
         return True
 
+    async def __get_status(self, operation: str, path: str, auth_data: str) -> int:
+        async with self.__request(operation, "GET", path, auth_data) as response:
+            if response.status >= 500:
+                raise HubUnavailableError(f"Jupyter hub responded with status {response.status}")
+            return response.status
+
     async def get_forwarding_args(self, connection_id: str, username: str, auth_data: str) -> Tuple[str, dict[str,Any]]:
+        entry = self.__lookup_server(username)
+        if entry is not None and entry.ready and entry.address is not None:
+            logging.getLogger(__name__).debug("[%s] Using indexed container address", connection_id)
+            return entry.address, {"port": 22, "username": username, "password": auth_data, **self.__internal_connect_options}
         try:
             # TODO Is this the correct server field?
-            async with self.__session.post(f"/hub/api/users/{username}", headers={"Authentication": f"token {auth_data}"}) as response:
+            async with self.__request("get_forwarding_args", "POST", f"/hub/api/users/{username}", auth_data) as response:
                 if response.status != 200:
                     raise BaseException()
                 server_url = (await response.json())["server"]
         except BaseException:
-            logging.getLogger(__name__).error(f"[{connection_id}] Failed to connect to jupyter hub")
+            logging.getLogger(__name__).error("[%s] Failed to connect to jupyter hub", connection_id)
             raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to retrieve forwarding information", "en-US")
-        return server_url, {"port": 22, "username": username, "password": auth_data}
+        return server_url, {"port": 22, "username": username, "password": auth_data, **self.__internal_connect_options}
 
-    async def start_server(self, connection_id: str, username: str, auth_data: str, retry_secs: int = 10) -> None:
-        logging.getLogger(__name__).debug(f"[{connection_id}] Attempting to start container")
+    async def start_server(self, connection_id: str, username: str, auth_data: str) -> None:
+        entry = self.__lookup_server(username)
+        if entry is not None and entry.ready:
+            logging.getLogger(__name__).info("[%s] Container already running", connection_id)
+            return
+        logging.getLogger(__name__).debug("[%s] Attempting to start container", connection_id)
+        # A single deadline for the spawn request and the wait for readiness, so that the spawn timeout bounds the whole start
+        deadline = time.monotonic() + self.__spawn_timeout_secs
         try:
             # TODO Is this the correct user server?
-            async with self.__session.post(f"/hub/api/users/{username}/server", headers={"Authentication": f"token {auth_data}"}) as response:
+            # The hub holds spawn requests for up to its slow_spawn_timeout before answering with 202, so only the spawn timeout applies
+            async with self.__request("start_server", "POST", f"/hub/api/users/{username}/server", auth_data, timeout=self.__slow_operation_timeout()) as response:
                 status_code = response.status
         except BaseException:
-            logging.getLogger(__name__).error(f"[{connection_id}] Failed to connect to jupyter hub")
+            logging.getLogger(__name__).error("[%s] Failed to connect to jupyter hub", connection_id)
             raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to connect to jupyter hub", "en-US")
-        if status_code in [201, 400]:  # BUG 400 means container is already running?
-            logging.getLogger(__name__).info(f"[{connection_id}] Container started")
-            return
-        elif status_code == 202 and retry_secs < 60:
-            await asyncio.sleep(retry_secs)
-            await self.start_server(connection_id, username, auth_data, retry_secs * 2)
-        else:
-            logging.getLogger(__name__).error(f"[{connection_id}] Failed to start container")
+        if status_code == 202:
+            try:
+                await asyncio.wait_for(self.__wait_for_spawn(connection_id, username, auth_data), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                logging.getLogger(__name__).error("[%s] Timed out while starting container", connection_id)
+                raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to start container", "en-US")
+        elif status_code not in [201, 400]:  # BUG 400 means container is already running?
+            logging.getLogger(__name__).error("[%s] Failed to start container", connection_id)
             raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to start container", "en-US")
+        logging.getLogger(__name__).info("[%s] Container started", connection_id)
+
+    async def __wait_for_spawn(self, connection_id: str, username: str, auth_data: str) -> None:
+        if self.__spawn_progress_stream:
+            try:
+                if await self.__wait_for_spawn_progress(connection_id, username, auth_data):
+                    return
+            except (aiohttp.ClientError, ValueError):
+                logging.getLogger(__name__).debug("[%s] Spawn progress stream unavailable", connection_id, exc_info=True)
+            logging.getLogger(__name__).debug("[%s] Falling back to polling for container readiness", connection_id)
+        await self.__poll_spawn(connection_id, username, auth_data)
+
+    async def __wait_for_spawn_progress(self, connection_id: str, username: str, auth_data: str) -> bool:
+        async with self.__request(
+            "spawn_progress",
+            "GET",
+            f"/hub/api/users/{username}/server/progress",
+            auth_data,
+            {"Accept": "text/event-stream"},
+            # The stream stays open for the whole spawn, which is bounded by the spawn timeout instead
+            aiohttp.ClientTimeout(total=None, sock_connect=self.__connect_timeout_secs),
+        ) as response:
+            if response.status != 200:
+                return False
+            async for line in response.content:
+                if not line.startswith(b"data:"):
+                    continue
+                event = json.loads(line[5:])
+                if event.get("ready", False):
+                    return True
+                if event.get("failed", False):
+                    logging.getLogger(__name__).error("[%s] Failed to start container: %s", connection_id, event.get('message', ''))
+                    raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to start container", "en-US")
+                logging.getLogger(__name__).debug("[%s] Spawn progress: %s", connection_id, event.get('message', ''))
+        return False
+
+    async def __poll_spawn(self, connection_id: str, username: str, auth_data: str) -> None:
+        poll_interval_secs = self.__spawn_poll_interval_secs
+        while True:
+            await asyncio.sleep(poll_interval_secs * random.uniform(0.5, 1.5))
+            poll_interval_secs = min(poll_interval_secs * 1.5, max(self.__spawn_poll_interval_secs, _MAX_SPAWN_POLL_INTERVAL_SECS))
+            try:
+                async with self.__request("poll_spawn", "GET", f"/hub/api/users/{username}", auth_data) as response:
+                    if response.status != 200:
+                        continue
+                    user = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                logging.getLogger(__name__).debug("[%s] Failed to poll container state", connection_id, exc_info=True)
+                continue
+            if user.get("server") is not None or user.get("servers", {}).get("", {}).get("ready", False):
+                return
+            if user.get("pending") is None:
+                logging.getLogger(__name__).error("[%s] Container stopped while starting", connection_id)
+                raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to start container", "en-US")
 
     async def stop_server(self, connection_id: str, username: str, auth_data: str) -> None:
-        logging.getLogger(__name__).debug(f"[{connection_id}] Attempting to stop container")
+        logging.getLogger(__name__).debug("[%s] Attempting to stop container", connection_id)
+        if self.__server_index is not None:
+            self.__server_index.invalidate(username)
         try:
-            async with self.__session.delete(f"/hub/api/users/{username}/server", headers={"Authentication": f"token {auth_data}"}) as response:
-                if response.status == 200:
-                    logging.getLogger(__name__).debug(f"[{connection_id}] Stopped unused container")
+            # Same for stop requests and the slow_stop_timeout of the hub
+            async with self.__request("stop_server", "DELETE", f"/hub/api/users/{username}/server", auth_data, timeout=self.__slow_operation_timeout()) as response:
+                if response.status in [200, 202, 204]:
+                    logging.getLogger(__name__).debug("[%s] Stopped unused container", connection_id)
                 else:
-                    logging.getLogger(__name__).error(f'[{connection_id}] Failed to stop unused container of user "{username}"')
+                    logging.getLogger(__name__).error('[%s] Failed to stop unused container of user "%s"', connection_id, username)
         except BaseException:
-            logging.getLogger(__name__).error(f"[{connection_id}] Failed to connect to jupyter hub")
+            logging.getLogger(__name__).error("[%s] Failed to connect to jupyter hub", connection_id)
+
+    def report_unreachable(self, connection_id: str, username: str) -> None:
+        # The indexed server may have been stopped outside of the proxy since the last refresh
+        if self.__server_index is not None:
+            logging.getLogger(__name__).debug("[%s] Removing unreachable container from the server index", connection_id)
+            self.__server_index.invalidate(username)
 
-    def finalize(self) -> None:
-        self.__session.close()
+    async def finalize(self) -> None:
+        if self.__server_index_task is not None:
+            self.__server_index_task.cancel()
+            await asyncio.gather(self.__server_index_task, return_exceptions=True)
+            self.__server_index_task = None
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from typing import Any, Optional, Tuple, TypeVar
+
+from better_jupyterhub_ssh.directory_service import DirectoryService
+
+
+class _UserServer:
+    __slots__ = ("sessions", "stop_handle", "idle_stop")
+
+    def __init__(self) -> None:
+        self.sessions = 0
+        self.stop_handle: Optional[asyncio.TimerHandle] = None
+        # Deadline and arguments of the idle stop cancelled by a login, until a session closes normally again
+        self.idle_stop: Optional[Tuple[float, str, Any]] = None
+
+
+T = TypeVar("T")
+class LifecycleDirectoryService(DirectoryService[T]):
+    def __init__(self, directory_service: DirectoryService[T], idle_grace_secs: Optional[float] = 60.0) -> None:
+        super().__init__()
+        self.__directory_service = directory_service
+        self.__idle_grace_secs = idle_grace_secs
+        self.__servers = dict[str, _UserServer]()
+        self.__stopping = dict[str, "asyncio.Task[None]"]()
+
+    def active_sessions(self, username: str) -> int:
+        server = self.__servers.get(username)
+        return server.sessions if server is not None else 0
+
+    def suspend_idle_stops(self) -> None:
+        # The containers may already be used through another process, e.g. the successor after a socket handoff
+        self.__idle_grace_secs = None
+        for username, server in list(self.__servers.items()):
+            if server.stop_handle is not None:
+                server.stop_handle.cancel()
+                server.stop_handle = None
+            server.idle_stop = None
+            if server.sessions == 0:
+                del self.__servers[username]
+
+    def resume_idle_stops(self, idle_grace_secs: float) -> None:
+        # Containers whose last session closed while suspended stay left to the culler of the hub, like those of the other process
+        self.__idle_grace_secs = idle_grace_secs
+
+    async def validate_auth(self, connection_id: str, username: str, auth_data: T) -> bool:
+        return await self.__directory_service.validate_auth(connection_id, username, auth_data)
+
+    async def get_forwarding_args(self, connection_id: str, username: str, auth_data: T) -> Tuple[str, dict[str,Any]]:
+        return await self.__directory_service.get_forwarding_args(connection_id, username, auth_data)
+
+    async def start_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        server = self.__servers.setdefault(username, _UserServer())
+        server.sessions += 1
+        if server.stop_handle is not None:
+            logging.getLogger(__name__).debug("[%s] Cancelled pending stop of idle container", connection_id)
+            server.stop_handle.cancel()
+            server.stop_handle = None
+        try:
+            stopping_task = self.__stopping.get(username)
+            if stopping_task is not None:
+                await asyncio.shield(stopping_task)
+            # Always passed on, the session count only decides when to stop: the container may have been stopped outside of the proxy (e.g. culled or crashed)
+            await self.__directory_service.start_server(connection_id, username, auth_data)
+        except BaseException:
+            server.sessions -= 1
+            if server.sessions == 0 and self.__servers.get(username) is server:
+                if server.idle_stop is not None and self.__idle_grace_secs is not None:
+                    # The container still runs for an earlier session, a failed login (e.g. a wrong password with speculative spawns) must not keep it from being stopped
+                    logging.getLogger(__name__).debug("[%s] Rescheduling stop of idle container", connection_id)
+                    self.__arm_idle_stop(username, server, *server.idle_stop)
+                else:
+                    del self.__servers[username]
+            raise
+
+    async def release_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        server = self.__servers.get(username)
+        if server is None or server.sessions == 0:
+            return
+        if server.sessions == 1 and server.idle_stop is not None and self.__idle_grace_secs is not None:
+            # The credentials were never validated, so the stop of an earlier session keeps its deadline and credentials
+            server.sessions -= 1
+            logging.getLogger(__name__).debug("[%s] Rescheduling stop of idle container", connection_id)
+            self.__arm_idle_stop(username, server, *server.idle_stop)
+            return
+        await self.stop_server(connection_id, username, auth_data)
+
+    async def stop_server(self, connection_id: str, username: str, auth_data: T) -> None:
+        server = self.__servers.get(username)
+        if server is None or server.sessions == 0:
+            return
+        server.sessions -= 1
+        if server.sessions > 0:
+            return
+        if self.__idle_grace_secs is None:
+            # Idle containers are left to the culler of the hub, the next login asks the hub again whether it is still running
+            logging.getLogger(__name__).debug("[%s] Leaving unused container running", connection_id)
+            if self.__servers.get(username) is server:
+                del self.__servers[username]
+            return
+        if self.__idle_grace_secs <= 0:
+            await self.__stop_idle(connection_id, username, auth_data, server)
+            return
+        logging.getLogger(__name__).debug("[%s] Stopping container in %ss if it stays unused", connection_id, self.__idle_grace_secs)
+        self.__arm_idle_stop(username, server, asyncio.get_running_loop().time() + self.__idle_grace_secs, connection_id, auth_data)
+
+    def __arm_idle_stop(self, username: str, server: _UserServer, when: float, connection_id: str, auth_data: T) -> None:
+        server.idle_stop = (when, connection_id, auth_data)
+        server.stop_handle = asyncio.get_running_loop().call_at(
+            when,
+            lambda: self.__schedule_stop_idle(connection_id, username, auth_data, server),
+        )
+
+    def __schedule_stop_idle(self, connection_id: str, username: str, auth_data: T, server: _UserServer) -> None:
+        _ = asyncio.ensure_future(self.__stop_idle(connection_id, username, auth_data, server))
+
+    async def __stop_idle(self, connection_id: str, username: str, auth_data: T, server: _UserServer) -> None:
+        server.stop_handle = None
+        server.idle_stop = None
+        if server.sessions > 0 or self.__servers.get(username) is not server:
+            return
+        del self.__servers[username]
+        stopping_task = asyncio.ensure_future(self.__directory_service.stop_server(connection_id, username, auth_data))
+        self.__stopping[username] = stopping_task
+        try:
+            await stopping_task
+        finally:
+            if self.__stopping.get(username) is stopping_task:
+                del self.__stopping[username]
+
+    def report_unreachable(self, connection_id: str, username: str) -> None:
+        self.__directory_service.report_unreachable(connection_id, username)
+
+    async def finalize(self) -> None:
+        # Idle containers are left running, they are reused by the next process or culled by the hub
+        for server in self.__servers.values():
+            if server.stop_handle is not None:
+                server.stop_handle.cancel()
+                server.stop_handle = None
+        if len(self.__stopping) > 0:
+            await asyncio.gather(*self.__stopping.values(), return_exceptions=True)
+        await self.__directory_service.finalize()
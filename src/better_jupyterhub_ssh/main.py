@@ -2,14 +2,32 @@ import argparse
 import asyncio
 from functools import partial
 import logging
+import os
 from pathlib import Path
 import re
+import signal
+import sys
+from typing import Any, Optional
 
+import aiohttp.web
 import asyncssh
 import asyncssh.packet
 
+from better_jupyterhub_ssh.admission_controller import AdmissionController
+from better_jupyterhub_ssh.coalescing_directory_service import CoalescingDirectoryService
+from better_jupyterhub_ssh.drain_controller import DrainController
+from better_jupyterhub_ssh.failed_login_limiter import FailedLoginLimiter
 from better_jupyterhub_ssh.jupyter_hub_directory_service import JupyterHubDirectoryService
+from better_jupyterhub_ssh.lifecycle_directory_service import LifecycleDirectoryService
+from better_jupyterhub_ssh.metrics_server import start_metrics_server
 from better_jupyterhub_ssh.proxy_server import SSHProxy
+from better_jupyterhub_ssh.socket_handoff import inherited_predecessor_fd, inherited_sockets, notify_ready, start_successor, wait_for_predecessor
+from better_jupyterhub_ssh.tracing import Tracer
+from better_jupyterhub_ssh.worker_supervisor import WorkerSupervisor
+
+
+# The proxy is the client on the internal leg, so this order decides the cipher. AES-GCM re-encrypted about twice as fast as chacha20-poly1305 in the benchmarks (on CPUs with AES instructions)
+_INTERNAL_ENCRYPTION_ALGS = ["aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "chacha20-poly1305@openssh.com", "aes128-ctr", "aes256-ctr"]
 
 
 def main() -> None:
@@ -17,60 +35,264 @@ def main() -> None:
     arg_parser.add_argument("hub_url", type=str)
     arg_parser.add_argument("-p", type=int, dest="port", default=22)
     arg_parser.add_argument("-k", type=Path, dest="host_key_dir", default="/etc/ssh")
+    arg_parser.add_argument("--auth-cache-size", type=int, dest="auth_cache_size", default=1024)
+    arg_parser.add_argument("--auth-cache-ttl", type=float, dest="auth_cache_ttl", default=300.0)
+    arg_parser.add_argument("--auth-cache-negative-ttl", type=float, dest="auth_cache_negative_ttl", default=10.0)
+    arg_parser.add_argument("--idle-grace-period", type=float, dest="idle_grace_period", default=60.0)
+    arg_parser.add_argument("--spawn-timeout", type=float, dest="spawn_timeout", default=300.0)
+    arg_parser.add_argument("--spawn-poll-interval", type=float, dest="spawn_poll_interval", default=1.0)
+    arg_parser.add_argument("--no-spawn-progress-stream", action="store_false", dest="spawn_progress_stream")
+    arg_parser.add_argument("--hub-max-connections", type=int, dest="hub_max_connections", default=100)
+    arg_parser.add_argument("--hub-keepalive-timeout", type=float, dest="hub_keepalive_timeout", default=30.0)
+    arg_parser.add_argument("--hub-connect-timeout", type=float, dest="hub_connect_timeout", default=5.0)
+    arg_parser.add_argument("--hub-request-timeout", type=float, dest="hub_request_timeout", default=30.0)
+    arg_parser.add_argument("--hub-total-request-timeout", type=float, dest="hub_total_request_timeout", default=60.0)
+    arg_parser.add_argument("--hub-retries", type=int, dest="hub_retries", default=2)
+    arg_parser.add_argument("--hub-circuit-failure-threshold", type=int, dest="hub_circuit_failure_threshold", default=5)
+    arg_parser.add_argument("--hub-circuit-reset-timeout", type=float, dest="hub_circuit_reset_timeout", default=30.0)
+    arg_parser.add_argument("--server-index", action="store_true", dest="server_index")
+    arg_parser.add_argument("--server-index-refresh-interval", type=float, dest="server_index_refresh_interval", default=10.0)
+    arg_parser.add_argument("--server-index-max-age", type=float, dest="server_index_max_age", default=30.0)
+    arg_parser.add_argument("--internal-port", type=int, dest="internal_port", default=22)
+    # The host keys of spawned containers are usually not known in advance, so whether to verify them has to be decided explicitly
+    internal_host_key_group = arg_parser.add_mutually_exclusive_group(required=True)
+    internal_host_key_group.add_argument("--internal-known-hosts", type=str, dest="internal_known_hosts", default=None)
+    internal_host_key_group.add_argument("--no-internal-host-key-check", action="store_true", dest="no_internal_host_key_check")
+    arg_parser.add_argument("--max-logins", type=int, dest="max_logins", default=0)
+    arg_parser.add_argument("--max-logins-per-user", type=int, dest="max_logins_per_user", default=0)
+    arg_parser.add_argument("--login-queue-size", type=int, dest="login_queue_size", default=1024)
+    arg_parser.add_argument("--login-queue-timeout", type=float, dest="login_queue_timeout", default=30.0)
+    arg_parser.add_argument("--speculative-spawn", action="store_true", dest="speculative_spawn")
+    arg_parser.add_argument("--speculative-spawn-max-failures", type=int, dest="speculative_spawn_max_failures", default=3)
+    arg_parser.add_argument("--speculative-spawn-failure-window", type=float, dest="speculative_spawn_failure_window", default=300.0)
+    arg_parser.add_argument("--write-buffer-high", type=int, dest="write_buffer_high", default=1 << 20)
+    arg_parser.add_argument("--write-buffer-low", type=int, dest="write_buffer_low", default=1 << 18)
+    for leg in ["client", "internal"]:
+        for algorithm_type in ["kex", "encryption", "mac", "compression"]:
+            arg_parser.add_argument(f"--{leg}-{algorithm_type}-algs", type=_algorithm_list, dest=f"{leg}_{algorithm_type}_algs", default=None)
+    arg_parser.add_argument("--drain-timeout", type=float, dest="drain_timeout", default=300.0)
+    arg_parser.add_argument("--handoff-timeout", type=float, dest="handoff_timeout", default=60.0)
+    arg_parser.add_argument("--trace-sample-rate", type=float, dest="trace_sample_rate", default=0.0)
+    arg_parser.add_argument("--trace-slow-login", type=float, dest="trace_slow_login", default=None)
+    arg_parser.add_argument("--trace-file", type=str, dest="trace_file", default="-")
+    arg_parser.add_argument("--workers", type=int, dest="workers", default=1)
+    arg_parser.add_argument("--metrics-host", type=str, dest="metrics_host", default="127.0.0.1")
+    arg_parser.add_argument("--metrics-port", type=int, dest="metrics_port", default=None)
     args = arg_parser.parse_args()
+    if args.server_index and "JUPYTERHUB_API_TOKEN" not in os.environ:
+        arg_parser.error("--server-index requires an admin token in JUPYTERHUB_API_TOKEN")
+    if not 0 <= args.write_buffer_low <= args.write_buffer_high:
+        arg_parser.error("--write-buffer-low must be between 0 and --write-buffer-high")
 
     logging.basicConfig(
-        format="%(asctime)s.%(msecs)03d [%(levelname)s][%(name)s]: %(message)s",
+        format=f"%(asctime)s.%(msecs)03d [%(levelname)s]{'[%(processName)s]' if args.workers > 1 else ''}[%(name)s]: %(message)s",
         datefmt="%H:%M:%S",
     )
     logging.getLogger().setLevel(logging.INFO)
     logging.getLogger("asyncssh").setLevel(logging.WARN)
 
-    # TODO Replace mock jupyter hub
-    # try:
-    #    jupyter_hub_facade = JupyterHubFacade(args.hub_url)
-    # except (OSError, asyncssh.Error) as exc:
-    #    logging.getLogger(__name__).fatal("Failed to setup jupyter hub facade", exc_info=True)
-    #    exit(-1)
-    import unittest.mock
-    jupyter_hub_directory_service = unittest.mock.MagicMock()
-    jupyter_hub_directory_service.validate_auth = unittest.mock.AsyncMock(return_value=True)
-    jupyter_hub_directory_service.get_forwarding_args = unittest.mock.AsyncMock(
-        return_value=(
-            "127.0.0.1",
-            {
-                "port": 22,
-                "username": "<USER>",
-                "password": "<PASSWORD>",
-                "known_hosts": None  # TODO Should internal host verification be disabled?
-            }
-        )
+    if args.workers > 1:
+        logging.getLogger(__name__).info("Idle containers are not stopped with multiple workers, since every worker only counts its own sessions")
+        WorkerSupervisor(args.workers, partial(_serve, args)).run()
+    else:
+        _serve(args)
+
+
+def _algorithm_list(value: str) -> list[str]:
+    return [algorithm.strip() for algorithm in value.split(",") if algorithm.strip() != ""]
+
+
+def _algorithm_options(args: argparse.Namespace, leg: str) -> dict[str, Any]:
+    algorithm_options = dict[str, Any]()
+    for algorithm_type in ["kex", "encryption", "mac", "compression"]:
+        algorithms = getattr(args, f"{leg}_{algorithm_type}_algs")
+        if algorithms is not None:
+            algorithm_options[f"{algorithm_type}_algs"] = algorithms
+    return algorithm_options
+
+
+def _internal_connect_options(args: argparse.Namespace) -> dict[str, Any]:
+    # The internal leg runs on the trusted cluster network, so compression is not worth its CPU cost by default
+    internal_connect_options: dict[str, Any] = {
+        "port": args.internal_port,
+        "encryption_algs": _INTERNAL_ENCRYPTION_ALGS,
+        "compression_algs": ["none"],
+        **_algorithm_options(args, "internal"),
+    }
+    # None disables the host key check of asyncssh
+    internal_connect_options["known_hosts"] = None if args.no_internal_host_key_check else args.internal_known_hosts
+    return internal_connect_options
+
+
+def _serve(args: argparse.Namespace, worker_index: Optional[int] = None) -> None:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    jupyter_hub_directory_service = JupyterHubDirectoryService(
+        args.hub_url,
+        auth_cache_size=args.auth_cache_size,
+        auth_cache_ttl_secs=args.auth_cache_ttl,
+        auth_cache_negative_ttl_secs=args.auth_cache_negative_ttl,
+        spawn_timeout_secs=args.spawn_timeout,
+        spawn_progress_stream=args.spawn_progress_stream,
+        spawn_poll_interval_secs=args.spawn_poll_interval,
+        internal_connect_options=_internal_connect_options(args),
+        max_connections=args.hub_max_connections,
+        keepalive_timeout_secs=args.hub_keepalive_timeout,
+        connect_timeout_secs=args.hub_connect_timeout,
+        request_timeout_secs=args.hub_request_timeout,
+        total_request_timeout_secs=args.hub_total_request_timeout,
+        retries=args.hub_retries,
+        circuit_failure_threshold=args.hub_circuit_failure_threshold,
+        circuit_reset_timeout_secs=args.hub_circuit_reset_timeout,
+        server_index_token=os.environ["JUPYTERHUB_API_TOKEN"] if args.server_index else None,
+        server_index_refresh_interval_secs=args.server_index_refresh_interval,
+        server_index_max_age_secs=args.server_index_max_age,
+    )
+    directory_service = LifecycleDirectoryService(
+        CoalescingDirectoryService(jupyter_hub_directory_service),
+        # Sessions of one user may be spread over all workers, so no worker knows when a container is actually idle
+        idle_grace_secs=args.idle_grace_period if worker_index is None else None,
     )
-    jupyter_hub_directory_service.start_server = unittest.mock.AsyncMock()
-    jupyter_hub_directory_service.stop_server = unittest.mock.AsyncMock()
-    jupyter_hub_directory_service.finalize = unittest.mock.AsyncMock()
+
+    predecessor_fd = inherited_predecessor_fd()
+    if predecessor_fd is not None:
+        # The previous process still drains sessions that use containers this process does not know about
+        directory_service.suspend_idle_stops()
+
+    admission_controller = None
+    if args.max_logins > 0 or args.max_logins_per_user > 0:
+        admission_controller = AdmissionController(
+            max_logins=args.max_logins,
+            max_logins_per_user=args.max_logins_per_user,
+            max_queue_size=args.login_queue_size,
+            queue_timeout_secs=args.login_queue_timeout,
+        )
+    speculative_spawn_limiter = None
+    if args.speculative_spawn:
+        speculative_spawn_limiter = FailedLoginLimiter(
+            max_failures=args.speculative_spawn_max_failures,
+            window_secs=args.speculative_spawn_failure_window,
+        )
+    drain_controller = DrainController()
+    tracer = None
+    trace_file = None
+    if args.trace_sample_rate > 0 or args.trace_slow_login is not None:
+        trace_file = sys.stdout if args.trace_file == "-" else open(args.trace_file, "a")
+        tracer = Tracer(trace_file, sample_rate=args.trace_sample_rate, slow_login_secs=args.trace_slow_login)
+    acceptors = list[asyncssh.SSHAcceptor]()
+    metrics_runner: Optional[aiohttp.web.AppRunner] = None
+    handoff_task: Optional[asyncio.Task[None]] = None
+    predecessor_task: Optional[asyncio.Task[None]] = None
 
     async def start_server() -> None:
         logging.getLogger(__name__).info("Starting jupyter hub SSH proxy...")
-        _ = await asyncssh.create_server(
-            partial(SSHProxy, jupyter_hub_directory_service),
-            host=None,
-            port=args.port,
+        create_server = partial(
+            asyncssh.create_server,
+            partial(SSHProxy, directory_service, admission_controller=admission_controller, drain_controller=drain_controller, tracer=tracer, speculative_spawn_limiter=speculative_spawn_limiter, write_buffer_high=args.write_buffer_high, write_buffer_low=args.write_buffer_low),
+            reuse_port=worker_index is not None,
+            **_algorithm_options(args, "client"),
             server_host_keys=list(list(map(lambda x: str(x.resolve()),filter(lambda x: x.is_file() and re.fullmatch(r"ssh_host_(ecdsa|ed25519|rsa)_key", x.name) is not None, args.host_key_dir.iterdir())))),
         )
-        logging.getLogger(__name__).info(f"Listening at port {args.port}")
+        sockets = inherited_sockets()
+        if len(sockets) > 0:
+            for sock in sockets:
+                acceptors.append(await create_server(sock=sock))
+            logging.getLogger(__name__).info("Listening at %s sockets inherited from the previous process", len(sockets))
+        else:
+            acceptors.append(await create_server(host=None, port=args.port))
+            logging.getLogger(__name__).info("Listening at port %s", args.port)
+
+    async def resume_idle_stops(predecessor_fd: int) -> None:
+        if await wait_for_predecessor(predecessor_fd, args.drain_timeout):
+            logging.getLogger(__name__).info("Previous process exited, stopping idle containers again")
+        else:
+            logging.getLogger(__name__).warning("Previous process did not exit within the drain timeout, stopping idle containers again")
+        if not drain_controller.draining:
+            directory_service.resume_idle_stops(args.idle_grace_period)
+
+    async def start_metrics() -> None:
+        nonlocal metrics_runner
+        if args.metrics_port is not None:
+            # Each worker serves its own metrics, on consecutive ports
+            metrics_runner = await start_metrics_server(args.metrics_host, args.metrics_port + (worker_index or 0))
+
+    async def stop_metrics() -> None:
+        nonlocal metrics_runner
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+            metrics_runner = None
+
+    async def drain() -> None:
+        if drain_controller.draining:
+            return
+        for acceptor in acceptors:
+            acceptor.close()
+        # Idle containers are left running, users reconnecting through the successor must not lose them
+        directory_service.suspend_idle_stops()
+        await drain_controller.drain(args.drain_timeout)
+        loop.stop()
+
+    async def handoff() -> None:
+        nonlocal handoff_task
+        try:
+            # The successor needs the metrics port, this process stops exporting metrics while it drains
+            await stop_metrics()
+            listen_fds = [sock.fileno() for acceptor in acceptors for sock in acceptor.sockets]
+            if await start_successor(listen_fds, args.handoff_timeout) is None:
+                await start_metrics()
+                return
+        finally:
+            handoff_task = None
+        await drain()
+
+    def handle_sigterm() -> None:
+        if drain_controller.draining:
+            # A second signal does not wait for the drain deadline
+            drain_controller.disconnect_all()
+            return
+        _ = loop.create_task(drain())
+
+    def handle_sigusr2() -> None:
+        nonlocal handoff_task
+        if drain_controller.draining or handoff_task is not None:
+            return
+        logging.getLogger(__name__).info("Handing the listening sockets over to a new process")
+        handoff_task = loop.create_task(handoff())
 
-    loop = asyncio.get_event_loop()
     try:
         loop.run_until_complete(start_server())
     except (OSError, asyncssh.Error):
         logging.getLogger(__name__).fatal("Failed to start server", exc_info=True)
         exit(-1)
+    try:
+        loop.run_until_complete(start_metrics())
+    except OSError:
+        logging.getLogger(__name__).fatal("Failed to start metrics server", exc_info=True)
+        exit(-1)
+    loop.add_signal_handler(signal.SIGTERM, handle_sigterm)
+    # Workers share the port via SO_REUSEPORT instead, a new instance can be started next to them before draining them
+    if worker_index is None:
+        loop.add_signal_handler(signal.SIGUSR2, handle_sigusr2)
+    if predecessor_fd is not None:
+        predecessor_task = loop.create_task(resume_idle_stops(predecessor_fd))
+    notify_ready()
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
-    jupyter_hub_directory_service.finalize()
+    if predecessor_task is not None:
+        predecessor_task.cancel()
+        loop.run_until_complete(asyncio.gather(predecessor_task, return_exceptions=True))
+    loop.run_until_complete(stop_metrics())
+    auth_cache = jupyter_hub_directory_service.auth_cache
+    logging.getLogger(__name__).info("Authentication cache: %s hits, %s misses, %s evictions", auth_cache.hits, auth_cache.misses, auth_cache.evictions)
+    server_index = jupyter_hub_directory_service.server_index
+    if server_index is not None:
+        logging.getLogger(__name__).info("Server index: %s hits, %s misses", server_index.hits, server_index.misses)
+    loop.run_until_complete(directory_service.finalize())
+    if trace_file is not None and trace_file is not sys.stdout:
+        trace_file.close()
 
 
 if __name__ == "__main__":
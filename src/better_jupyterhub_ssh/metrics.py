@@ -0,0 +1,110 @@
+from bisect import bisect_left
+from typing import Iterator, Sequence, Tuple, Union
+
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped_labels = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped_labels) + "}"
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels: Tuple[Tuple[str, str], ...]) -> None:
+        self.labels = labels
+        self.value: Union[int, float] = 0  # Incremented directly on hot paths, to avoid a method call
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        self.value += amount
+
+    def samples(self, name: str) -> Iterator[str]:
+        yield f"{name}{_format_labels(self.labels)} {_format_value(self.value)}"
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def dec(self, amount: Union[int, float] = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: Union[int, float]) -> None:
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("labels", "buckets", "bucket_counts", "sum", "count")
+
+    def __init__(self, labels: Tuple[Tuple[str, str], ...], buckets: Sequence[float] = _DEFAULT_BUCKETS) -> None:
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str) -> Iterator[str]:
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative_count += bucket_count
+            yield f"{name}_bucket{_format_labels(self.labels + (('le', _format_value(upper_bound)),))} {cumulative_count}"
+        yield f"{name}_bucket{_format_labels(self.labels + (('le', '+Inf'),))} {self.count}"
+        yield f"{name}_sum{_format_labels(self.labels)} {_format_value(self.sum)}"
+        yield f"{name}_count{_format_labels(self.labels)} {self.count}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        super().__init__()
+        self.__families = dict[str, Tuple[str, str, dict[Tuple[Tuple[str, str], ...], Union[Counter, Histogram]]]]()
+
+    def __get(self, type_name: str, name: str, help_text: str, labels: dict[str, str], factory: type) -> Union[Counter, Histogram]:
+        family = self.__families.setdefault(name, (type_name, help_text, {}))
+        if family[0] != type_name:
+            raise ValueError(f'Metric "{name}" is already registered as {family[0]}')
+        label_tuple = tuple(sorted(labels.items()))
+        metric = family[2].get(label_tuple)
+        if metric is None:
+            metric = factory(label_tuple)
+            family[2][label_tuple] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        return self.__get("counter", name, help_text, labels, Counter)  # type: ignore
+
+    def gauge(self, name: str, help_text: str, **labels: str) -> Gauge:
+        return self.__get("gauge", name, help_text, labels, Gauge)  # type: ignore
+
+    def histogram(self, name: str, help_text: str, **labels: str) -> Histogram:
+        return self.__get("histogram", name, help_text, labels, Histogram)  # type: ignore
+
+    def render(self) -> str:
+        lines = list[str]()
+        for name, (type_name, help_text, metrics) in sorted(self.__families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {type_name}")
+            for metric in metrics.values():
+                lines.extend(metric.samples(name))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
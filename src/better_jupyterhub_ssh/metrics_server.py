@@ -0,0 +1,19 @@
+import logging
+
+import aiohttp.web
+
+from better_jupyterhub_ssh.metrics import REGISTRY
+
+
+async def _handle_metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    return aiohttp.web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str, port: int) -> aiohttp.web.AppRunner:
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, host, port).start()
+    logging.getLogger(__name__).info("Serving metrics at http://%s:%s/metrics", host, port)
+    return runner
@@ -1,13 +1,21 @@
+from array import array
 import asyncio
 import copy
 from functools import partial
 import logging
-from typing import Any, Callable, DefaultDict, Optional, cast
+import os
+import time
+from typing import Any, Callable, Optional, Tuple, cast
 
 import asyncssh
 import asyncssh.packet
 
+from better_jupyterhub_ssh.admission_controller import AdmissionController
 from better_jupyterhub_ssh.directory_service import DirectoryService
+from better_jupyterhub_ssh.drain_controller import DrainController
+from better_jupyterhub_ssh.failed_login_limiter import FailedLoginLimiter
+from better_jupyterhub_ssh.metrics import REGISTRY, Counter, Histogram
+from better_jupyterhub_ssh.tracing import NULL_TRACE, NullTrace, Tracer
 
 
 _FORWARDED_MESSAGE_TYPES = [
@@ -22,6 +30,198 @@ _FORWARDED_MESSAGE_TYPES = [
     asyncssh.MSG_CHANNEL_OPEN_CONFIRMATION,
     asyncssh.MSG_CHANNEL_OPEN_FAILURE,
 ]
+_CHANNEL_DATA_MESSAGE_TYPES = frozenset([
+    asyncssh.MSG_CHANNEL_DATA,
+    asyncssh.MSG_CHANNEL_EXTENDED_DATA,
+])
+
+_CLIENT_CONNECTIONS = REGISTRY.gauge("jupyter_ssh_proxy_client_connections", "Currently open client connections")
+_INTERNAL_CONNECTIONS = REGISTRY.gauge("jupyter_ssh_proxy_internal_connections", "Currently open internal connections")
+_PAUSED_READS = REGISTRY.gauge("jupyter_ssh_proxy_paused_reads", "Number of connection legs currently not read from due to backpressure")
+
+
+def _login_phase_histogram(phase: str) -> Histogram:
+    return REGISTRY.histogram("jupyter_ssh_proxy_login_phase_seconds", "Duration of the individual login phases", phase=phase)
+
+
+_AUTH_SECONDS = _login_phase_histogram("auth")
+_SPAWN_SECONDS = _login_phase_histogram("spawn")
+_FORWARDING_ARGS_SECONDS = _login_phase_histogram("forwarding_args")
+_INTERNAL_CONNECT_SECONDS = _login_phase_histogram("internal_connect")
+_INTERNAL_AUTH_SECONDS = _login_phase_histogram("internal_auth")
+_PATCH_SECONDS = _login_phase_histogram("patch")
+
+
+def _speculative_spawn_counter(outcome: str) -> Counter:
+    return REGISTRY.counter("jupyter_ssh_proxy_speculative_spawns_total", "Number of logins by whether the spawn was started before the credentials were validated", outcome=outcome)
+
+
+_SPECULATIVE_SPAWNS_STARTED = _speculative_spawn_counter("started")
+_SPECULATIVE_SPAWNS_SKIPPED = _speculative_spawn_counter("skipped")
+_SPECULATIVE_SPAWNS_ABANDONED = _speculative_spawn_counter("abandoned")
+
+
+def _send_payload(conn: asyncssh.connection.SSHConnection, pkt_type: int, payload: bytes) -> None:
+    # Equivalent to conn.send_packet(pkt_type, payload[1:]), but frames the received payload (which
+    # already starts with the message type) directly instead of slicing and re-concatenating it
+    if (
+        not conn._auth_complete  # type: ignore
+        or not conn._kex_complete  # type: ignore
+        or conn._rekey_bytes_sent >= conn._rekey_bytes  # type: ignore
+        or (conn._rekey_seconds and time.monotonic() >= conn._rekey_time)  # type: ignore
+    ):
+        conn.send_packet(pkt_type, payload[1:])
+        return
+    if conn._send_encryption and pkt_type not in (asyncssh.MSG_IGNORE, asyncssh.MSG_EXT_INFO):  # type: ignore
+        conn.send_packet(asyncssh.MSG_IGNORE, asyncssh.packet.String(b""))
+    orig_payload = payload
+    if conn._compressor:  # type: ignore
+        payload = conn._compressor.compress(payload)  # type: ignore
+        if payload is None:
+            raise asyncssh.CompressionError("Compression failed")
+    padlen = -(conn._send_enchdrlen + len(payload)) % conn._send_blocksize  # type: ignore
+    if padlen < 4:
+        padlen += conn._send_blocksize  # type: ignore
+    packet = asyncssh.packet.Byte(padlen) + payload + os.urandom(padlen)
+    pktlen = len(packet)
+    hdr = asyncssh.packet.UInt32(pktlen)
+    seq = conn._send_seq  # type: ignore
+    if conn._send_encryption:  # type: ignore
+        packet, mac = conn._send_encryption.encrypt_packet(seq, hdr, packet)  # type: ignore
+    else:
+        packet = hdr + packet
+        mac = b""
+    conn._send(packet + mac)  # type: ignore
+    conn._send_seq = (seq + 1) & 0xffffffff  # type: ignore
+    conn._rekey_bytes_sent += pktlen  # type: ignore
+    conn.log_sent_packet(pkt_type, seq, orig_payload)
+
+
+class _SequenceNumberMap:
+    __slots__ = ("__sent", "__received", "__size")
+
+    def __init__(self, size: int = 128) -> None:
+        self.__sent = array("q", [-1]) * size
+        self.__received = array("q", [-1]) * size
+        self.__size = size
+
+    def __setitem__(self, sent_seq_num: int, received_seq_num: int) -> None:
+        index = sent_seq_num % self.__size
+        self.__sent[index] = sent_seq_num
+        self.__received[index] = received_seq_num
+
+    def __getitem__(self, sent_seq_num: int) -> int:
+        index = sent_seq_num % self.__size
+        if self.__sent[index] != sent_seq_num:
+            raise KeyError(sent_seq_num)
+        return self.__received[index]
+
+    def __contains__(self, sent_seq_num: int) -> bool:
+        return self.__sent[sent_seq_num % self.__size] == sent_seq_num
+
+
+class _Forwarder:
+    # Used both as connection packet handler and as stand-in for every channel of a connection
+    __slots__ = ("other_conn", "seq_num_map", "packet_counter", "byte_counter")
+
+    def __init__(self, other_conn: asyncssh.connection.SSHConnection, seq_num_map: _SequenceNumberMap, direction: str) -> None:
+        self.other_conn = other_conn
+        self.seq_num_map = seq_num_map
+        self.packet_counter = REGISTRY.counter("jupyter_ssh_proxy_forwarded_packets_total", "Number of forwarded packets", direction=direction)
+        self.byte_counter = REGISTRY.counter("jupyter_ssh_proxy_forwarded_bytes_total", "Number of forwarded payload bytes", direction=direction)
+
+    def __call__(self, conn: asyncssh.connection.SSHConnection, pkt_type: int, pkt_id: int, pkt: asyncssh.packet.SSHPacket) -> bool:
+        return self.forward(pkt_type, pkt_id, pkt)
+
+    def forward(self, pkt_type: int, pkt_id: int, pkt: asyncssh.packet.SSHPacket) -> bool:
+        other_conn = self.other_conn
+        payload = pkt.get_full_payload()
+        self.packet_counter.value += 1
+        self.byte_counter.value += len(payload)
+        _send_payload(other_conn, pkt_type, payload)
+        # Recorded after sending, since asyncssh may insert an SSH_MSG_IGNORE packet in front
+        self.seq_num_map[(other_conn._send_seq - 1) & 0xffffffff] = pkt_id  # type: ignore
+        return True
+
+    def process_packet(self, pkt_type: int, pkt_id: int, pkt: asyncssh.packet.SSHPacket) -> bool:
+        # Fast path for bulk data, which is never referenced by SSH_MSG_UNIMPLEMENTED in practice
+        if pkt_type in _CHANNEL_DATA_MESSAGE_TYPES:
+            payload = pkt.get_full_payload()
+            self.packet_counter.value += 1
+            self.byte_counter.value += len(payload)
+            _send_payload(self.other_conn, pkt_type, payload)
+            return True
+        return self.forward(pkt_type, pkt_id, pkt)
+
+    def log_received_packet(self, pkt_type: int, pkt_id: int, pkt: asyncssh.packet.SSHPacket, note: str = "") -> None:
+        pass
+
+    def process_connection_close(self, exc: Optional[Exception]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class _FlowControl:
+    # Pauses reading on the opposite leg while the write buffer of this leg is above the high watermark
+    __slots__ = ("conn", "other_conn", "pause_counter", "peak_gauge", "paused", "pause_count", "peak_buffered_bytes")
+
+    def __init__(self, conn: asyncssh.connection.SSHConnection, other_conn: asyncssh.connection.SSHConnection, direction: str, high: int, low: int) -> None:
+        self.conn = conn
+        self.other_conn = other_conn
+        self.pause_counter = REGISTRY.counter("jupyter_ssh_proxy_backpressure_pauses_total", "Number of times reading was paused due to a full write buffer of the opposite leg", direction=direction)
+        self.peak_gauge = REGISTRY.gauge("jupyter_ssh_proxy_peak_buffered_bytes", "Largest write buffer of a connection leg when reading from the opposite leg was paused", direction=direction)
+        self.paused = False
+        self.pause_count = 0
+        self.peak_buffered_bytes = 0
+        conn.pause_writing = self.pause_writing  # type: ignore
+        conn.resume_writing = self.resume_writing  # type: ignore
+        conn._transport.set_write_buffer_limits(high=high, low=low)  # type: ignore
+
+    @property
+    def buffered_bytes(self) -> int:
+        transport = self.conn._transport  # type: ignore
+        return transport.get_write_buffer_size() if transport is not None else 0
+
+    def pause_writing(self) -> None:
+        self.paused = True
+        self.pause_count += 1
+        self.pause_counter.value += 1
+        self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+        if self.peak_buffered_bytes > self.peak_gauge.value:
+            self.peak_gauge.set(self.peak_buffered_bytes)
+        _PAUSED_READS.value += 1
+        other_transport = self.other_conn._transport  # type: ignore
+        if other_transport is not None:
+            other_transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        # The transport of the remaining leg may still drain its buffer after close
+        if not self.paused:
+            return
+        self.paused = False
+        _PAUSED_READS.value -= 1
+        other_transport = self.other_conn._transport  # type: ignore
+        if other_transport is not None:
+            other_transport.resume_reading()
+
+    def close(self) -> None:
+        if self.paused:
+            self.paused = False
+            _PAUSED_READS.value -= 1
+
+
+class _ForwardingChannels(dict[int, Any]):
+    # Resolves every channel number to the same forwarder, without storing anything per channel
+    __slots__ = ("forwarder",)
+
+    def __init__(self, forwarder: _Forwarder) -> None:
+        super().__init__()
+        self.forwarder = forwarder
+
+    def __missing__(self, recv_chan: int) -> _Forwarder:
+        return self.forwarder
 
 
 class _InternalProxyClient(asyncssh.SSHClient):
@@ -29,192 +229,289 @@ class _InternalProxyClient(asyncssh.SSHClient):
         super().__init__()
         self.authenticated_event = asyncio.Event()
 
+    def connection_made(self, conn: asyncssh.SSHClientConnection) -> None:
+        _INTERNAL_CONNECTIONS.value += 1
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        _INTERNAL_CONNECTIONS.value -= 1
+
     def auth_completed(self) -> None:
         self.authenticated_event.set()
 
 
+class _Preparation:
+    __slots__ = ("username", "auth_data", "server_started", "task")
+
+    def __init__(self, username: str, auth_data: Any) -> None:
+        # Tracked per login attempt, every attempt on a connection may start (and then has to release) its own spawn
+        self.username = username
+        self.auth_data = auth_data
+        self.server_started = False
+        self.task: asyncio.Task[Tuple[str, dict[str, Any]]] | None = None
+
+
 class SSHProxy(asyncssh.SSHServer):
-    def __init__(self, directory_service: DirectoryService[str]) -> None:
+    def __init__(self, directory_service: DirectoryService[str], admission_controller: Optional[AdmissionController] = None, drain_controller: Optional[DrainController] = None, tracer: Optional[Tracer] = None, speculative_spawn_limiter: Optional[FailedLoginLimiter] = None, write_buffer_high: int = 1 << 20, write_buffer_low: int = 1 << 18) -> None:
         super().__init__()
         self.__username = cast(str, None)
         self.__auth_data = cast(Any, None)
         self.__client_connection = cast(asyncssh.SSHServerConnection, None)
         self.__server_connection = cast(asyncssh.SSHClientConnection, None)
+        self.__connection_id = cast(str, None)
+        self.__connection_ids = cast(str, None)
         self.__setup_forwarding_task: asyncio.Task[None] | None = None
+        self.__preparation: _Preparation | None = None
         self.__directory_service = directory_service
+        self.__admission_controller = admission_controller
+        self.__drain_controller = drain_controller
+        self.__tracer = tracer
+        self.__speculative_spawn_limiter = speculative_spawn_limiter
+        self.__trace: NullTrace = NULL_TRACE
+        self.__write_buffer_high = write_buffer_high
+        self.__write_buffer_low = write_buffer_low
+        self.__flow_control_c2s: _FlowControl | None = None
+        self.__flow_control_s2c: _FlowControl | None = None
 
     def connection_made(self, conn: asyncssh.SSHServerConnection) -> None:
         self.__client_connection = conn
-        logging.getLogger(__name__).info(f"[{self.__client_connection.logger._context}] New connection from {conn.get_extra_info('peername')[0]}:{conn.get_extra_info('peername')[1]}")  # type: ignore
+        self.__connection_id = conn.logger._context  # type: ignore
+        _CLIENT_CONNECTIONS.value += 1
+        if self.__drain_controller is not None:
+            self.__drain_controller.register(conn)
+        if self.__tracer is not None:
+            self.__trace = self.__tracer.start_trace(self.__connection_id)
+        peername = conn.get_extra_info("peername")
+        self.__trace.event("connect", peer=peername)
+        logging.getLogger(__name__).info("[%s] New connection from %s:%s", self.__connection_id, peername[0], peername[1])
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
+        _CLIENT_CONNECTIONS.value -= 1
         if exc is not None:
-            logging.getLogger(__name__).error(f"[{self.__client_connection.logger._context}] Connection lost:", exc_info=(type(exc), exc, exc.__traceback__))  # type: ignore
+            logging.getLogger(__name__).error("[%s] Connection lost:", self.__connection_id, exc_info=(type(exc), exc, exc.__traceback__))
         else:
-            logging.getLogger(__name__).info(f"[{self.__client_connection.logger._context}] Connection closed by client")  # type: ignore
+            logging.getLogger(__name__).info("[%s] Connection closed by client", self.__connection_id)
+        if self.__flow_control_c2s is not None and self.__flow_control_s2c is not None:
+            if logging.getLogger(__name__).isEnabledFor(logging.DEBUG):
+                logging.getLogger(__name__).debug("[%s] Buffer stats: %s", self.__connection_id, self.get_buffer_stats())
+            self.__flow_control_c2s.close()
+            self.__flow_control_s2c.close()
         if self.__setup_forwarding_task is not None:
-            logging.getLogger(__name__).debug(f"[{self.__client_connection.logger._context}] Closing internal connection")  # type: ignore
-            if self.__setup_forwarding_task.done():
-                self.__client_connection.create_task(self.__directory_service.stop_server(self.__client_connection.logger._context, self.__username, self.__auth_data))  # type: ignore
+            logging.getLogger(__name__).debug("[%s] Closing internal connection", self.__connection_id)
+            preparation = self.__preparation
+            if preparation is not None and preparation.server_started:
+                self.__client_connection.create_task(self.__directory_service.stop_server(self.__connection_id, preparation.username, preparation.auth_data))
             self.__setup_forwarding_task.cancel()
+        if self.__drain_controller is not None:
+            self.__drain_controller.unregister(self.__client_connection)
+        self.__trace.finish(error=exc)
     
+    def get_buffer_stats(self) -> dict[str, dict[str, int]]:
+        stats = dict[str, dict[str, int]]()
+        for direction, flow_control in [("c2s", self.__flow_control_c2s), ("s2c", self.__flow_control_s2c)]:
+            if flow_control is not None:
+                stats[direction] = {
+                    "buffered_bytes": flow_control.buffered_bytes,
+                    "peak_buffered_bytes": flow_control.peak_buffered_bytes,
+                    "pause_count": flow_control.pause_count,
+                }
+        return stats
+
     def password_auth_supported(self) -> bool:
         return True
 
     async def validate_password(self, username: str, password: str) -> bool:
         self.__username = username
         self.__auth_data = password
-        logging.getLogger(__name__).info(f'[{self.__client_connection.logger._context}] Login attempt by user "{self.__username}"')  # type: ignore
-        valid = await self.__directory_service.validate_auth(self.__client_connection.logger._context, username, password)  # type: ignore
+        logging.getLogger(__name__).info('[%s] Login attempt by user "%s"', self.__connection_id, self.__username)
+        try:
+            if self.__admission_controller is None:
+                return await self.__login()
+            started_at = time.perf_counter()
+            async with self.__admission_controller.admit(self.__connection_id, username):
+                self.__trace.add_span("admission", started_at, time.perf_counter())
+                return await self.__login()
+        finally:
+            self.__trace.login_completed()
+
+    async def __login(self) -> bool:
+        trace = self.__trace
+        limiter = self.__speculative_spawn_limiter
+        speculation: _Preparation | None = None
+        if limiter is not None:
+            # Users with recently failed logins have to be validated first, so invalid credentials cannot trigger spawns
+            if limiter.allows(self.__username):
+                _SPECULATIVE_SPAWNS_STARTED.value += 1
+                speculation = _Preparation(self.__username, self.__auth_data)
+                speculation.task = asyncio.ensure_future(self.__prepare_internal(speculation))
+            else:
+                _SPECULATIVE_SPAWNS_SKIPPED.value += 1
+        started_at = time.perf_counter()
+        try:
+            valid = await self.__directory_service.validate_auth(self.__connection_id, self.__username, self.__auth_data)
+        except BaseException:
+            if speculation is not None:
+                self.__abandon_speculation(speculation)
+            raise
+        ended_at = time.perf_counter()
+        _AUTH_SECONDS.observe(ended_at - started_at)
+        trace.add_span("auth", started_at, ended_at, username=self.__username, valid=valid)
+        if limiter is not None:
+            if valid:
+                limiter.record_success(self.__username)
+            else:
+                limiter.record_failure(self.__username)
         if valid:
-            logging.getLogger(__name__).info(f'[{self.__client_connection.logger._context}] Login successful')  # type: ignore
-            self.__setup_forwarding_task = asyncio.ensure_future(self.__connect_internal())
+            logging.getLogger(__name__).info("[%s] Login successful", self.__connection_id)
+            self.__preparation = speculation if speculation is not None else _Preparation(self.__username, self.__auth_data)
+            self.__setup_forwarding_task = asyncio.ensure_future(self.__connect_internal(self.__preparation))
             done, _ = await asyncio.wait([self.__setup_forwarding_task])
             try:
                 next(iter(done)).result()
-            except BaseException:
+            except BaseException as exc:
+                trace.event("login_failed", error=exc)
                 raise asyncssh.DisconnectError(asyncssh.DISC_BY_APPLICATION, "Failed to connect to internal host", "en-US")
             return True
-        logging.getLogger(__name__).info(f'[{self.__client_connection.logger._context}] Invalid credentials')  # type: ignore
+        if speculation is not None:
+            self.__abandon_speculation(speculation)
+        logging.getLogger(__name__).info("[%s] Invalid credentials", self.__connection_id)
         return False
 
-    async def __connect_internal(self) -> None:
-        await self.__directory_service.start_server(self.__client_connection.logger._context, self.__username, self.__auth_data)  # type: ignore
-        logging.getLogger(__name__).debug(f"[{self.__client_connection.logger._context}] Connecting to internal host")  # type: ignore
-        (container_address, kwargs) = await self.__directory_service.get_forwarding_args(self.__client_connection.logger._context, self.__username, self.__auth_data)  # type: ignore
-        self.__server_connection, _ = await asyncssh.create_connection(_InternalProxyClient, host=container_address, **kwargs)
-        logging.getLogger(__name__).debug(f"[{self.__client_connection.logger._context}] Connected internally to {container_address}{':'+str(kwargs['port']) if 'port' in kwargs else ''}")  # type: ignore
+    def __abandon_speculation(self, speculation: _Preparation) -> None:
+        _SPECULATIVE_SPAWNS_ABANDONED.value += 1
+        self.__trace.event("speculation_abandoned", spawned=speculation.server_started)
+        _ = asyncio.ensure_future(self.__release_speculation(speculation))
+
+    async def __release_speculation(self, speculation: _Preparation) -> None:
+        assert speculation.task is not None
+        # A spawn in progress is left to finish, cancelling it would leave a container the hub started but nobody stops
+        if speculation.server_started:
+            speculation.task.cancel()
+        try:
+            await speculation.task
+        except BaseException:
+            pass
+        if speculation.server_started:
+            logging.getLogger(__name__).debug("[%s] Releasing speculatively started container", self.__connection_id)
+            await self.__directory_service.release_server(self.__connection_id, speculation.username, speculation.auth_data)
+
+    async def __prepare_internal(self, preparation: _Preparation) -> Tuple[str, dict[str, Any]]:
+        trace = self.__trace
+        started_at = time.perf_counter()
+        await self.__directory_service.start_server(self.__connection_id, preparation.username, preparation.auth_data)
+        preparation.server_started = True
+        ended_at = time.perf_counter()
+        _SPAWN_SECONDS.observe(ended_at - started_at)
+        trace.add_span("spawn", started_at, ended_at)
+        started_at = ended_at
+        forwarding_args = await self.__directory_service.get_forwarding_args(self.__connection_id, preparation.username, preparation.auth_data)
+        ended_at = time.perf_counter()
+        _FORWARDING_ARGS_SECONDS.observe(ended_at - started_at)
+        trace.add_span("forwarding_args", started_at, ended_at)
+        return forwarding_args
+
+    async def __connect_internal(self, preparation: _Preparation) -> None:
+        trace = self.__trace
+        (container_address, kwargs) = await (preparation.task if preparation.task is not None else self.__prepare_internal(preparation))
+        logging.getLogger(__name__).debug("[%s] Connecting to internal host", self.__connection_id)
+        started_at = time.perf_counter()
+        try:
+            self.__server_connection, _ = await asyncssh.create_connection(_InternalProxyClient, host=container_address, **kwargs)
+        except (OSError, asyncio.TimeoutError, asyncssh.Error):
+            self.__directory_service.report_unreachable(self.__connection_id, preparation.username)
+            raise
+        self.__connection_ids = f"{self.__connection_id} & {self.__server_connection.logger._context}"  # type: ignore
+        ended_at = time.perf_counter()
+        _INTERNAL_CONNECT_SECONDS.observe(ended_at - started_at)
+        trace.add_span("internal_connect", started_at, ended_at, address=container_address, port=kwargs.get("port"))
+        logging.getLogger(__name__).debug("[%s] Connected internally to %s:%s", self.__connection_id, container_address, kwargs.get("port", 22))
+        started_at = ended_at
         _ = await cast(_InternalProxyClient, self.__server_connection._owner).authenticated_event.wait()  # type: ignore
-        logging.getLogger(__name__).debug(f"[{self.__client_connection.logger._context} & {self.__server_connection.logger._context}] Attempting to patch connections")  # type: ignore
+        ended_at = time.perf_counter()
+        _INTERNAL_AUTH_SECONDS.observe(ended_at - started_at)
+        trace.add_span("internal_auth", started_at, ended_at)
+        logging.getLogger(__name__).debug("[%s] Attempting to patch connections", self.__connection_ids)
+        started_at = ended_at
         await self.__patch_connections()
-        logging.getLogger(__name__).debug(f"[{self.__client_connection.logger._context} & {self.__server_connection.logger._context}] Connections patched")  # type: ignore
+        ended_at = time.perf_counter()
+        _PATCH_SECONDS.observe(ended_at - started_at)
+        trace.add_span("patch", started_at, ended_at)
+        logging.getLogger(__name__).debug("[%s] Connections patched", self.__connection_ids)
 
     async def __patch_connections(self) -> None:
-        seq_num_map_c2s = dict[int, int]()
-        seq_num_map_s2c = dict[int, int]()
+        seq_num_map_c2s = _SequenceNumberMap()
+        seq_num_map_s2c = _SequenceNumberMap()
+        forwarder_c2s = _Forwarder(self.__server_connection, seq_num_map_c2s, "c2s")
+        forwarder_s2c = _Forwarder(self.__client_connection, seq_num_map_s2c, "s2c")
 
         packet_handlers = cast(dict[int, Callable[[asyncssh.connection.SSHConnection, int, int, asyncssh.packet.SSHPacket], bool]], self.__client_connection._packet_handlers)  # type: ignore
         packet_handlers = copy.copy(packet_handlers)
         for message_type in _FORWARDED_MESSAGE_TYPES:
-            packet_handlers[message_type] = partial(self.__forward, seq_num_map_c2s, self.__server_connection)
+            packet_handlers[message_type] = forwarder_c2s
         packet_handlers[asyncssh.MSG_UNIMPLEMENTED] = partial(
             self.__handle_unimplemented_msg,
-            seq_num_map_c2s,
+            forwarder_c2s,
             seq_num_map_s2c,
             packet_handlers[asyncssh.MSG_UNIMPLEMENTED],
-            self.__server_connection,
         )
         del packet_handlers[asyncssh.MSG_EXT_INFO]
         packet_handlers[asyncssh.MSG_SERVICE_REQUEST] = partial(
             self.__handle_service_msg,
-            seq_num_map_c2s,
+            forwarder_c2s,
             packet_handlers[asyncssh.MSG_SERVICE_REQUEST],
-            self.__server_connection,
         )
         packet_handlers[asyncssh.MSG_SERVICE_ACCEPT] = partial(
             self.__handle_service_msg,
-            seq_num_map_c2s,
+            forwarder_c2s,
             packet_handlers[asyncssh.MSG_SERVICE_ACCEPT],
-            self.__server_connection,
         )
         packet_handlers[asyncssh.MSG_DISCONNECT] = partial(
             self.__handle_disconnect_msg,
-            seq_num_map_c2s,
+            forwarder_c2s,
             packet_handlers[asyncssh.MSG_DISCONNECT],
-            self.__server_connection,
         )
         self.__client_connection._packet_handlers = packet_handlers  # type: ignore
-        self.__client_connection._channels = DefaultDict[int, Any](  # type: ignore
-            lambda: type(
-                "DummySSHChannel",
-                (object,),
-                {
-                    "process_packet": partial(
-                        self.__forward,
-                        seq_num_map_c2s,
-                        self.__server_connection,
-                        self.__client_connection,
-                    ),
-                    "log_received_packet": lambda a, b, c, d: None,
-                    "process_connection_close": lambda a: None,
-                    "close": lambda: None,
-                },
-            )
-        )
+        self.__client_connection._channels = _ForwardingChannels(forwarder_c2s)  # type: ignore
         self.__client_connection._send_ext_info = lambda: None  # type: ignore
 
         packet_handlers = cast(dict[int, Callable[[asyncssh.connection.SSHConnection, int, int, asyncssh.packet.SSHPacket], bool]], self.__server_connection._packet_handlers)  # type: ignore
         packet_handlers = copy.copy(packet_handlers)
         for message_type in _FORWARDED_MESSAGE_TYPES:
-            packet_handlers[message_type] = partial(self.__forward, seq_num_map_s2c, self.__client_connection)
+            packet_handlers[message_type] = forwarder_s2c
         packet_handlers[asyncssh.MSG_UNIMPLEMENTED] = partial(
             self.__handle_unimplemented_msg,
-            seq_num_map_s2c,
+            forwarder_s2c,
             seq_num_map_c2s,
             packet_handlers[asyncssh.MSG_UNIMPLEMENTED],
-            self.__client_connection,
         )
         del packet_handlers[asyncssh.MSG_EXT_INFO]
         packet_handlers[asyncssh.MSG_SERVICE_REQUEST] = partial(
             self.__handle_service_msg,
-            seq_num_map_s2c,
+            forwarder_s2c,
             packet_handlers[asyncssh.MSG_SERVICE_REQUEST],
-            self.__client_connection,
         )
         packet_handlers[asyncssh.MSG_SERVICE_ACCEPT] = partial(
             self.__handle_service_msg,
-            seq_num_map_s2c,
+            forwarder_s2c,
             packet_handlers[asyncssh.MSG_SERVICE_ACCEPT],
-            self.__client_connection,
         )
         packet_handlers[asyncssh.MSG_USERAUTH_BANNER] = packet_handlers[asyncssh.MSG_USERAUTH_BANNER]
         packet_handlers[asyncssh.MSG_DISCONNECT] = partial(
             self.__handle_disconnect_msg,
-            seq_num_map_s2c,
+            forwarder_s2c,
             packet_handlers[asyncssh.MSG_DISCONNECT],
-            self.__client_connection,
         )
         self.__server_connection._packet_handlers = packet_handlers  # type: ignore
-        self.__server_connection._channels = DefaultDict[int, Any](  # type: ignore
-            lambda: type(
-                "DummySSHChannel",
-                (object,),
-                {
-                    "process_packet": partial(
-                        self.__forward,
-                        seq_num_map_s2c,
-                        self.__client_connection,
-                        self.__server_connection,
-                    ),
-                    "log_received_packet": lambda a, b, c, d: None,
-                    "process_connection_close": lambda a: None,
-                    "close": lambda: None,
-                },
-            )
-        )
+        self.__server_connection._channels = _ForwardingChannels(forwarder_s2c)  # type: ignore
         self.__server_connection._send_ext_info = lambda: None  # type: ignore
 
-    def __forward(
-        self,
-        seq_num_map: dict[int, int],
-        other_conn: asyncssh.connection.SSHConnection,
-        conn: asyncssh.connection.SSHConnection,
-        pkt_type: int,
-        pkt_id: int,
-        pkt: asyncssh.packet.SSHPacket,
-    ) -> bool:
-        if len(seq_num_map) > 100:
-            del seq_num_map[(next(iter(seq_num_map)))]
-        seq_num_map[other_conn._send_seq] = pkt_id  # type: ignore
-        other_conn.send_packet(pkt_type, pkt.get_full_payload()[1:])
-        return True
+        self.__flow_control_c2s = _FlowControl(self.__server_connection, self.__client_connection, "c2s", self.__write_buffer_high, self.__write_buffer_low)
+        self.__flow_control_s2c = _FlowControl(self.__client_connection, self.__server_connection, "s2c", self.__write_buffer_high, self.__write_buffer_low)
 
     def __handle_unimplemented_msg(
         self,
-        seq_num_map: dict[int, int],
-        other_seq_num_map: dict[int, int],
+        forwarder: _Forwarder,
+        other_seq_num_map: _SequenceNumberMap,
         orig_handler: Callable[[asyncssh.connection.SSHConnection, int, int, asyncssh.packet.SSHPacket], bool],
-        other_conn: asyncssh.connection.SSHConnection,
         conn: asyncssh.connection.SSHConnection,
         pkt_type: int,
         pkt_id: int,
@@ -222,17 +519,16 @@ class SSHProxy(asyncssh.SSHServer):
     ) -> bool:
         unimplemented_seq_num = pkt.get_uint32()
         pkt._idx = 1  # type: ignore
-        if unimplemented_seq_num in seq_num_map:
-            self.__forward(seq_num_map, other_conn, conn, pkt_type, other_seq_num_map[pkt_id], pkt)
+        if unimplemented_seq_num in forwarder.seq_num_map:
+            forwarder.forward(pkt_type, other_seq_num_map[pkt_id], pkt)
         else:
             orig_handler(conn, pkt_type, pkt_id, pkt)
         return True
 
     def __handle_service_msg(
         self,
-        seq_num_map: dict[int, int],
+        forwarder: _Forwarder,
         orig_handler: Callable[[asyncssh.connection.SSHConnection, int, int, asyncssh.packet.SSHPacket],bool],
-        other_conn: asyncssh.connection.SSHConnection,
         conn: asyncssh.connection.SSHConnection,
         pkt_type: int,
         pkt_id: int,
@@ -243,19 +539,18 @@ class SSHProxy(asyncssh.SSHServer):
         if service_name.decode("ascii") == "ssh-userauth":
             orig_handler(conn, pkt_type, pkt_id, pkt)
         else:
-            self.__forward(seq_num_map, other_conn, conn, pkt_type, pkt_id, pkt)
+            forwarder.forward(pkt_type, pkt_id, pkt)
         return True
 
     def __handle_disconnect_msg(
         self,
-        seq_num_map: dict[int, int],
+        forwarder: _Forwarder,
         orig_handler: Callable[[asyncssh.connection.SSHConnection, int, int, asyncssh.packet.SSHPacket],bool],
-        other_conn: asyncssh.connection.SSHConnection,
         conn: asyncssh.connection.SSHConnection,
         pkt_type: int,
         pkt_id: int,
         pkt: asyncssh.packet.SSHPacket,
     ) -> bool:
-        self.__forward(seq_num_map, other_conn, conn, pkt_type, pkt_id, pkt)
+        forwarder.forward(pkt_type, pkt_id, pkt)
         orig_handler(conn, pkt_type, pkt_id, pkt)
         return True
@@ -0,0 +1,58 @@
+import time
+from typing import Any, Iterable, Optional
+
+
+class ServerEntry:
+    __slots__ = ("address", "ready", "pending")
+
+    def __init__(self, address: Optional[str], ready: bool, pending: Optional[str]) -> None:
+        self.address = address
+        self.ready = ready
+        self.pending = pending
+
+
+class ServerIndex:
+    def __init__(self, max_age_secs: float = 30.0) -> None:
+        super().__init__()
+        self.__max_age_secs = max_age_secs
+        self.__entries = dict[str, ServerEntry]()
+        self.__refreshed_at = float("-inf")
+        self.__invalidated_at = dict[str, float]()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() - self.__refreshed_at <= self.__max_age_secs
+
+    def get(self, username: str) -> Optional[ServerEntry]:
+        entry = self.__entries.get(username) if self.fresh else None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def replace(self, users: Iterable[dict[str, Any]], started_at: float) -> None:
+        entries = dict[str, ServerEntry]()
+        for user in users:
+            username = user["name"]
+            # Users changed locally while the listing was in flight would be overwritten with outdated state
+            if self.__invalidated_at.get(username, float("-inf")) >= started_at:
+                continue
+            server = user.get("servers", {}).get("", {})
+            entries[username] = ServerEntry(
+                user.get("server"),
+                user.get("server") is not None or server.get("ready", False),
+                user.get("pending"),
+            )
+        self.__entries = entries
+        self.__refreshed_at = started_at
+        self.__invalidated_at = {username: invalidated_at for username, invalidated_at in self.__invalidated_at.items() if invalidated_at >= started_at}
+
+    def invalidate(self, username: str) -> None:
+        self.__entries.pop(username, None)
+        self.__invalidated_at[username] = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
@@ -0,0 +1,28 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+class SingleFlight(Generic[K, V]):
+    def __init__(self) -> None:
+        super().__init__()
+        self.__in_flight = dict[K, "asyncio.Future[V]"]()
+
+    def __len__(self) -> int:
+        return len(self.__in_flight)
+
+    async def run(self, key: K, factory: Callable[[], Awaitable[V]]) -> V:
+        future = self.__in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.__in_flight[key] = future
+            future.add_done_callback(lambda done_future: self.__finish(key, done_future))
+        # Shielded, so that a cancelled waiter does not cancel the shared call for all others
+        return await asyncio.shield(future)
+
+    def __finish(self, key: K, future: "asyncio.Future[V]") -> None:
+        if self.__in_flight.get(key) is future:
+            del self.__in_flight[key]
+        if not future.cancelled():
+            _ = future.exception()  # Mark as retrieved, in case all waiters are gone
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+import socket
+import subprocess
+import sys
+from typing import Optional, Sequence
+
+
+_LISTEN_FDS_ENV = "JUPYTER_SSH_PROXY_LISTEN_FDS"
+_READY_FD_ENV = "JUPYTER_SSH_PROXY_READY_FD"
+_PREDECESSOR_FD_ENV = "JUPYTER_SSH_PROXY_PREDECESSOR_FD"
+
+
+def inherited_sockets() -> list[socket.socket]:
+    fds = os.environ.pop(_LISTEN_FDS_ENV, "")
+    return [socket.socket(fileno=int(fd)) for fd in fds.split(",") if fd != ""]
+
+
+def notify_ready() -> None:
+    ready_fd = os.environ.pop(_READY_FD_ENV, None)
+    if ready_fd is None:
+        return
+    try:
+        os.write(int(ready_fd), b"\n")
+    finally:
+        os.close(int(ready_fd))
+
+
+def inherited_predecessor_fd() -> Optional[int]:
+    predecessor_fd = os.environ.pop(_PREDECESSOR_FD_ENV, None)
+    return int(predecessor_fd) if predecessor_fd is not None else None
+
+
+async def wait_for_predecessor(predecessor_fd: int, timeout_secs: float) -> bool:
+    # The predecessor holds the write end of the pipe until it exits, so EOF marks its exit
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(predecessor_fd, "rb"))
+    try:
+        await asyncio.wait_for(reader.read(), timeout_secs)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        transport.close()
+
+
+async def start_successor(listen_fds: Sequence[int], ready_timeout_secs: float) -> Optional[subprocess.Popen]:
+    # The successor inherits the listening sockets, so pending and new connections are never refused while it starts
+    ready_read_fd, ready_write_fd = os.pipe()
+    # The write end is never closed explicitly, the successor sees EOF once this process exited
+    exit_read_fd, exit_write_fd = os.pipe()
+    try:
+        successor = subprocess.Popen(
+            [sys.executable, "-m", "better_jupyterhub_ssh.main", *sys.argv[1:]],
+            pass_fds=[*listen_fds, ready_write_fd, exit_read_fd],
+            env={**os.environ, _LISTEN_FDS_ENV: ",".join(map(str, listen_fds)), _READY_FD_ENV: str(ready_write_fd), _PREDECESSOR_FD_ENV: str(exit_read_fd)},
+            start_new_session=True,
+        )
+    except OSError:
+        os.close(ready_read_fd)
+        os.close(exit_write_fd)
+        logging.getLogger(__name__).error("Failed to start successor process", exc_info=True)
+        return None
+    finally:
+        os.close(ready_write_fd)
+        os.close(exit_read_fd)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(ready_read_fd, "rb"))
+    try:
+        # EOF without data means the successor exited before it was ready
+        ready = await asyncio.wait_for(reader.read(1), ready_timeout_secs) != b""
+    except asyncio.TimeoutError:
+        ready = False
+    finally:
+        transport.close()
+    if not ready:
+        logging.getLogger(__name__).error("Successor process %s did not become ready, keeping the current process", successor.pid)
+        successor.terminate()
+        await loop.run_in_executor(None, successor.wait)
+        os.close(exit_write_fd)
+        return None
+    logging.getLogger(__name__).info("Successor process %s is ready", successor.pid)
+    return successor
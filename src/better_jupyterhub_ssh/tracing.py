@@ -0,0 +1,91 @@
+import json
+import random
+import time
+from typing import Any, Optional, TextIO
+
+
+class NullTrace:
+    __slots__ = ()
+
+    def add_span(self, name: str, started_at: float, ended_at: float, **attributes: Any) -> None:
+        pass
+
+    def event(self, name: str, **attributes: Any) -> None:
+        pass
+
+    def login_completed(self) -> None:
+        pass
+
+    def finish(self, **attributes: Any) -> None:
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Trace(NullTrace):
+    __slots__ = ("tracer", "connection_id", "sampled", "started_at", "started_at_wall", "spans", "login_secs")
+
+    def __init__(self, tracer: "Tracer", connection_id: str, sampled: bool) -> None:
+        self.tracer = tracer
+        self.connection_id = connection_id
+        self.sampled = sampled
+        self.started_at = time.perf_counter()
+        self.started_at_wall = time.time()
+        # Kept as raw tuples, they are only formatted if the trace is emitted
+        self.spans = list[tuple[str, float, Optional[float], dict[str, Any]]]()
+        self.login_secs: Optional[float] = None
+
+    def add_span(self, name: str, started_at: float, ended_at: float, **attributes: Any) -> None:
+        self.spans.append((name, started_at, ended_at, attributes))
+
+    def event(self, name: str, **attributes: Any) -> None:
+        self.spans.append((name, time.perf_counter(), None, attributes))
+
+    def login_completed(self) -> None:
+        self.login_secs = time.perf_counter() - self.started_at
+
+    def finish(self, **attributes: Any) -> None:
+        self.event("close", **attributes)
+        self.tracer.emit(self)
+
+    def to_record(self) -> dict[str, Any]:
+        spans = list[dict[str, Any]]()
+        for name, started_at, ended_at, attributes in self.spans:
+            span: dict[str, Any] = {"name": name, "offset_secs": round(started_at - self.started_at, 6)}
+            if ended_at is not None:
+                span["duration_secs"] = round(ended_at - started_at, 6)
+            span.update(attributes)
+            spans.append(span)
+        return {
+            "connection_id": self.connection_id,
+            "timestamp": self.started_at_wall,
+            "duration_secs": round(time.perf_counter() - self.started_at, 6),
+            "login_secs": round(self.login_secs, 6) if self.login_secs is not None else None,
+            "sampled": self.sampled,
+            "spans": spans,
+        }
+
+
+class Tracer:
+    def __init__(self, output: TextIO, sample_rate: float = 0.0, slow_login_secs: Optional[float] = None) -> None:
+        super().__init__()
+        self.__output = output
+        self.__sample_rate = sample_rate
+        self.__slow_login_secs = slow_login_secs
+        self.emitted = 0
+
+    def start_trace(self, connection_id: str) -> NullTrace:
+        sampled = random.random() < self.__sample_rate
+        # Unsampled connections are only recorded if they might turn out to be slow logins
+        if not sampled and self.__slow_login_secs is None:
+            return NULL_TRACE
+        return Trace(self, connection_id, sampled)
+
+    def emit(self, trace: Trace) -> None:
+        if not trace.sampled and (self.__slow_login_secs is None or trace.login_secs is None or trace.login_secs < self.__slow_login_secs):
+            return
+        # Written and flushed as a whole, so that the traces of multiple workers sharing a file do not interleave
+        self.__output.write(json.dumps(trace.to_record(), default=repr) + "\n")
+        self.__output.flush()
+        self.emitted += 1
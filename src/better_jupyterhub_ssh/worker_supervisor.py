@@ -0,0 +1,84 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+from typing import Any, Callable
+
+
+_MIN_WORKER_UPTIME_SECS = 5.0
+_MAX_RESTART_DELAY_SECS = 30.0
+
+
+def _run_worker(target: Callable[[int], None], index: int) -> None:
+    # Forked workers inherit the handlers of the supervisor, which must not run before the worker installed its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    target(index)
+
+
+class _Worker:
+    def __init__(self, index: int, target: Callable[[int], None]) -> None:
+        self.index = index
+        self.restart_delay_secs = 0.0
+        self.process = multiprocessing.Process(target=_run_worker, args=(target, index), name=f"worker-{index}")
+        self.process.start()
+        self.started_at = time.monotonic()
+
+
+class WorkerSupervisor:
+    def __init__(self, worker_count: int, target: Callable[[int], None]) -> None:
+        super().__init__()
+        self.__worker_count = worker_count
+        self.__target = target
+        self.__workers = dict[int, _Worker]()
+        self.__stopping = False
+
+    def run(self) -> None:
+        previous_sigterm_handler = signal.signal(signal.SIGTERM, self.__handle_sigterm)
+        previous_sigusr2_handler = signal.signal(signal.SIGUSR2, self.__handle_sigusr2)
+        try:
+            for index in range(self.__worker_count):
+                self.__workers[index] = _Worker(index, self.__target)
+            logging.getLogger(__name__).info("Started %s workers", self.__worker_count)
+            while not self.__stopping:
+                sentinels = {worker.process.sentinel: worker for worker in self.__workers.values()}
+                for sentinel in multiprocessing.connection.wait(list(sentinels.keys())):
+                    if not self.__stopping:
+                        self.__restart(sentinels[sentinel])  # type: ignore
+        except KeyboardInterrupt:
+            self.__stopping = True
+        finally:
+            self.__stop_workers()
+            signal.signal(signal.SIGTERM, previous_sigterm_handler)
+            signal.signal(signal.SIGUSR2, previous_sigusr2_handler)
+
+    def __restart(self, worker: _Worker) -> None:
+        worker.process.join()
+        logging.getLogger(__name__).error("Worker %s exited with code %s, restarting", worker.index, worker.process.exitcode)
+        # Back off on workers that crash right after starting, e.g. due to a bad configuration
+        if time.monotonic() - worker.started_at < _MIN_WORKER_UPTIME_SECS:
+            restart_delay_secs = min(max(worker.restart_delay_secs * 2, 1.0), _MAX_RESTART_DELAY_SECS)
+            time.sleep(restart_delay_secs)
+        else:
+            restart_delay_secs = 0.0
+        if self.__stopping:
+            return
+        self.__workers[worker.index] = _Worker(worker.index, self.__target)
+        self.__workers[worker.index].restart_delay_secs = restart_delay_secs
+
+    def __handle_sigterm(self, signum: int, frame: Any) -> None:
+        self.__stopping = True
+        raise KeyboardInterrupt()
+
+    def __handle_sigusr2(self, signum: int, frame: Any) -> None:
+        logging.getLogger(__name__).warning("Socket handoff is not supported with multiple workers, start a new instance next to this one and send SIGTERM instead")
+
+    def __stop_workers(self) -> None:
+        for worker in self.__workers.values():
+            if worker.process.is_alive():
+                # Workers stop accepting and drain their connections on SIGTERM
+                worker.process.terminate()
+        for worker in self.__workers.values():
+            worker.process.join()
+        logging.getLogger(__name__).info("All workers stopped")
@@ -0,0 +1,142 @@
+import asyncio
+
+import asyncssh
+import pytest
+
+from better_jupyterhub_ssh.admission_controller import AdmissionController
+
+
+async def _hold(admission_controller: AdmissionController, username: str, admitted: list[str], release: asyncio.Event) -> None:
+    async with admission_controller.admit(username, username):
+        admitted.append(username)
+        await release.wait()
+
+
+async def _settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_limit_queues_and_admits_on_release() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=2)
+        admitted = list[str]()
+        releases = [asyncio.Event() for _ in range(3)]
+        tasks = [asyncio.ensure_future(_hold(admission_controller, f"user{i}", admitted, releases[i])) for i in range(3)]
+        await _settle()
+        assert admitted == ["user0", "user1"]
+        assert admission_controller.queue_depth == 1
+        releases[0].set()
+        await _settle()
+        assert admitted == ["user0", "user1", "user2"]
+        assert admission_controller.queue_depth == 0
+        for release in releases:
+            release.set()
+        await asyncio.gather(*tasks)
+    asyncio.run(scenario())
+
+
+def test_queued_logins_are_admitted_in_order() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=1)
+        admitted = list[str]()
+        release = asyncio.Event()
+        tasks = list[asyncio.Future[None]]()
+        for i in range(4):
+            tasks.append(asyncio.ensure_future(_hold(admission_controller, f"user{i}", admitted, release)))
+            await _settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admitted == ["user0", "user1", "user2", "user3"]
+    asyncio.run(scenario())
+
+
+def test_user_at_limit_does_not_block_others() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=3, max_logins_per_user=1)
+        admitted = list[str]()
+        alice_release, bob_release = asyncio.Event(), asyncio.Event()
+        first_alice = asyncio.ensure_future(_hold(admission_controller, "alice", admitted, alice_release))
+        await _settle()
+        second_alice = asyncio.ensure_future(_hold(admission_controller, "alice", admitted, alice_release))
+        await _settle()
+        bob = asyncio.ensure_future(_hold(admission_controller, "bob", admitted, bob_release))
+        await _settle()
+        assert admitted == ["alice", "bob"]
+        assert admission_controller.queue_depth == 1
+        alice_release.set()
+        await asyncio.gather(first_alice, second_alice)
+        assert admitted == ["alice", "bob", "alice"]
+        bob_release.set()
+        await bob
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=1, max_queue_size=1)
+        admitted = list[str]()
+        release = asyncio.Event()
+        tasks = [asyncio.ensure_future(_hold(admission_controller, f"user{i}", admitted, release)) for i in range(2)]
+        await _settle()
+        with pytest.raises(asyncssh.DisconnectError) as exc_info:
+            async with admission_controller.admit("user2", "user2"):
+                pass
+        assert exc_info.value.code == asyncssh.DISC_TOO_MANY_CONNECTIONS
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admitted == ["user0", "user1"]
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_rejects_and_leaves_queue() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=1, queue_timeout_secs=0.05)
+        admitted = list[str]()
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(_hold(admission_controller, "user0", admitted, release))
+        await _settle()
+        with pytest.raises(asyncssh.DisconnectError) as exc_info:
+            async with admission_controller.admit("user1", "user1"):
+                pass
+        assert exc_info.value.code == asyncssh.DISC_TOO_MANY_CONNECTIONS
+        assert admission_controller.queue_depth == 0
+        release.set()
+        await holder
+        async with admission_controller.admit("user2", "user2"):
+            pass
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue_without_taking_a_slot() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=1)
+        admitted = list[str]()
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(_hold(admission_controller, "user0", admitted, release))
+        await _settle()
+        cancelled = asyncio.ensure_future(_hold(admission_controller, "user1", admitted, release))
+        await _settle()
+        waiting = asyncio.ensure_future(_hold(admission_controller, "user2", admitted, release))
+        await _settle()
+        assert admission_controller.queue_depth == 2
+        cancelled.cancel()
+        await _settle()
+        assert cancelled.cancelled()
+        assert admission_controller.queue_depth == 1
+        release.set()
+        await asyncio.gather(holder, waiting)
+        assert admitted == ["user0", "user2"]
+        assert admission_controller.queue_depth == 0
+    asyncio.run(scenario())
+
+
+def test_slot_is_released_on_error() -> None:
+    async def scenario() -> None:
+        admission_controller = AdmissionController(max_logins=1, queue_timeout_secs=0.05)
+        with pytest.raises(RuntimeError):
+            async with admission_controller.admit("user0", "user0"):
+                raise RuntimeError()
+        async with admission_controller.admit("user1", "user1"):
+            pass
+    asyncio.run(scenario())
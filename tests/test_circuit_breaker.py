@@ -0,0 +1,60 @@
+import time
+
+from better_jupyterhub_ssh.circuit_breaker import CircuitBreaker
+
+
+def _open_circuit_breaker(reset_timeout_secs: float) -> CircuitBreaker:
+    circuit_breaker = CircuitBreaker(failure_threshold=3, reset_timeout_secs=reset_timeout_secs)
+    for _ in range(3):
+        assert circuit_breaker.allow_request()
+        circuit_breaker.record_failure()
+    return circuit_breaker
+
+
+def test_opens_after_consecutive_failures() -> None:
+    circuit_breaker = CircuitBreaker(failure_threshold=3, reset_timeout_secs=60.0)
+    circuit_breaker.record_failure()
+    circuit_breaker.record_failure()
+    circuit_breaker.record_success()
+    circuit_breaker.record_failure()
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    assert not circuit_breaker.allow_request()
+
+
+def test_never_opens_without_threshold() -> None:
+    circuit_breaker = CircuitBreaker(failure_threshold=0)
+    for _ in range(100):
+        circuit_breaker.record_failure()
+    assert circuit_breaker.allow_request()
+
+
+def test_half_open_allows_single_trial() -> None:
+    circuit_breaker = _open_circuit_breaker(0.01)
+    time.sleep(0.02)
+    assert circuit_breaker.allow_request()
+    assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    assert not circuit_breaker.allow_request()
+    circuit_breaker.record_abandoned()
+    assert circuit_breaker.allow_request()
+
+
+def test_successful_trial_closes() -> None:
+    circuit_breaker = _open_circuit_breaker(0.01)
+    time.sleep(0.02)
+    assert circuit_breaker.allow_request()
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    assert circuit_breaker.allow_request()
+    assert circuit_breaker.allow_request()
+
+
+def test_failed_trial_opens_again() -> None:
+    circuit_breaker = _open_circuit_breaker(0.05)
+    time.sleep(0.06)
+    assert circuit_breaker.allow_request()
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    assert not circuit_breaker.allow_request()
@@ -0,0 +1,63 @@
+import time
+
+from better_jupyterhub_ssh.credential_cache import CredentialCache
+
+
+def test_caches_results() -> None:
+    credential_cache = CredentialCache()
+    assert credential_cache.get("alice", "token") is None
+    credential_cache.put("alice", "token", True)
+    credential_cache.put("bob", "token", False)
+    assert credential_cache.get("alice", "token") is True
+    assert credential_cache.get("bob", "token") is False
+    assert credential_cache.get("alice", "other-token") is None
+    assert (credential_cache.hits, credential_cache.misses) == (2, 2)
+
+
+def test_results_expire_after_ttl() -> None:
+    credential_cache = CredentialCache(ttl_secs=0.05, negative_ttl_secs=60.0)
+    credential_cache.put("alice", "token", True)
+    credential_cache.put("bob", "token", False)
+    time.sleep(0.06)
+    assert credential_cache.get("alice", "token") is None
+    assert credential_cache.get("bob", "token") is False
+    assert len(credential_cache) == 1
+
+
+def test_failures_expire_after_negative_ttl() -> None:
+    credential_cache = CredentialCache(ttl_secs=60.0, negative_ttl_secs=0.05)
+    credential_cache.put("alice", "token", True)
+    credential_cache.put("bob", "token", False)
+    time.sleep(0.06)
+    assert credential_cache.get("alice", "token") is True
+    assert credential_cache.get("bob", "token") is None
+
+
+def test_zero_ttl_disables_caching() -> None:
+    credential_cache = CredentialCache(negative_ttl_secs=0.0)
+    credential_cache.put("bob", "token", False)
+    assert credential_cache.get("bob", "token") is None
+    assert len(credential_cache) == 0
+
+
+def test_least_recently_used_result_is_evicted() -> None:
+    credential_cache = CredentialCache(max_size=2)
+    credential_cache.put("alice", "token", True)
+    credential_cache.put("bob", "token", True)
+    assert credential_cache.get("alice", "token") is True
+    credential_cache.put("carol", "token", True)
+    assert len(credential_cache) == 2
+    assert credential_cache.evictions == 1
+    assert credential_cache.get("bob", "token") is None
+    assert credential_cache.get("alice", "token") is True
+    assert credential_cache.get("carol", "token") is True
+
+
+def test_invalidate_and_clear() -> None:
+    credential_cache = CredentialCache()
+    credential_cache.put("alice", "token", True)
+    credential_cache.put("bob", "token", True)
+    credential_cache.invalidate("alice", "token")
+    assert credential_cache.get("alice", "token") is None
+    credential_cache.clear()
+    assert len(credential_cache) == 0
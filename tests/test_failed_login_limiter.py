@@ -0,0 +1,55 @@
+import time
+
+from better_jupyterhub_ssh.failed_login_limiter import FailedLoginLimiter
+
+
+def test_blocks_after_max_failures() -> None:
+    failed_login_limiter = FailedLoginLimiter(max_failures=3)
+    for _ in range(2):
+        failed_login_limiter.record_failure("alice")
+    assert failed_login_limiter.allows("alice")
+    failed_login_limiter.record_failure("alice")
+    assert not failed_login_limiter.allows("alice")
+    assert failed_login_limiter.allows("bob")
+
+
+def test_success_clears_failures() -> None:
+    failed_login_limiter = FailedLoginLimiter(max_failures=2)
+    failed_login_limiter.record_failure("alice")
+    failed_login_limiter.record_failure("alice")
+    failed_login_limiter.record_success("alice")
+    assert failed_login_limiter.allows("alice")
+    failed_login_limiter.record_failure("alice")
+    assert failed_login_limiter.allows("alice")
+    assert len(failed_login_limiter) == 1
+
+
+def test_failures_are_forgotten_after_window() -> None:
+    failed_login_limiter = FailedLoginLimiter(max_failures=2, window_secs=0.05)
+    failed_login_limiter.record_failure("alice")
+    failed_login_limiter.record_failure("alice")
+    assert not failed_login_limiter.allows("alice")
+    time.sleep(0.06)
+    assert failed_login_limiter.allows("alice")
+    assert len(failed_login_limiter) == 0
+
+
+def test_failure_after_window_starts_new_window() -> None:
+    failed_login_limiter = FailedLoginLimiter(max_failures=2, window_secs=0.05)
+    failed_login_limiter.record_failure("alice")
+    time.sleep(0.06)
+    failed_login_limiter.record_failure("alice")
+    assert failed_login_limiter.allows("alice")
+    failed_login_limiter.record_failure("alice")
+    assert not failed_login_limiter.allows("alice")
+
+
+def test_tracked_users_are_bounded() -> None:
+    failed_login_limiter = FailedLoginLimiter(max_failures=1, max_users=2)
+    for username in ["alice", "bob", "carol"]:
+        failed_login_limiter.record_failure(username)
+    assert len(failed_login_limiter) == 2
+    # The least recently failed user is forgotten first
+    assert failed_login_limiter.allows("alice")
+    assert not failed_login_limiter.allows("bob")
+    assert not failed_login_limiter.allows("carol")
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import time
+from typing import Any
+
+import aiohttp.web
+import asyncssh
+import pytest
+
+from better_jupyterhub_ssh.jupyter_hub_directory_service import JupyterHubDirectoryService
+
+
+class _Hub:
+    def __init__(self) -> None:
+        super().__init__()
+        self.status = 200
+        self.delay_secs = 0.0
+        self.bodies = dict[str, Any]()
+        self.statuses = dict[str, int]()
+        # Paths answered with these server-sent events, the stream is held open afterwards for stream_hold_secs
+        self.events = dict[str, list[dict[str, Any]]]()
+        self.stream_hold_secs = 0.0
+        self.requests = list[tuple[str, str]]()
+        self.__runner: aiohttp.web.AppRunner | None = None
+
+    async def start(self) -> str:
+        app = aiohttp.web.Application()
+        app.router.add_route("*", "/{path:.*}", self.__handle)
+        self.__runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        site = aiohttp.web.TCPSite(self.__runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def __handle(self, request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+        self.requests.append((request.method, request.path))
+        await asyncio.sleep(self.delay_secs)
+        status = self.statuses.get(request.path, self.status)
+        events = self.events.get(request.path)
+        if events is None or status != 200:
+            return aiohttp.web.json_response(self.bodies.get(request.path, {"name": "alice", "server": None}), status=status)
+        response = aiohttp.web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for event in events:
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await asyncio.sleep(self.stream_hold_secs)
+        await response.write_eof()
+        return response
+
+
+def _run(scenario: Any, **options: Any) -> None:
+    async def run() -> None:
+        hub = _Hub()
+        hub_url = await hub.start()
+        directory_service = JupyterHubDirectoryService(hub_url, retry_backoff_secs=0.01, **options)
+        try:
+            await scenario(directory_service, hub)
+        finally:
+            await directory_service.finalize()
+            await hub.stop()
+    asyncio.run(run())
+
+
+def test_get_requests_are_retried() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.status = 503
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c0", "alice", "token")
+        # The other lookup is still retried after the first one failed
+        await asyncio.sleep(0.2)
+        assert hub.requests.count(("GET", "/hub/api/users/alice")) == 3
+        assert hub.requests.count(("GET", "/hub/api/users/alice/tokens/token")) == 3
+    _run(scenario, retries=2, circuit_failure_threshold=0)
+
+
+def test_other_requests_are_not_retried() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.status = 503
+        await directory_service.stop_server("c0", "alice", "token")
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.start_server("c0", "alice", "token")
+        assert hub.requests == [("DELETE", "/hub/api/users/alice/server"), ("POST", "/hub/api/users/alice/server")]
+    _run(scenario, retries=2, circuit_failure_threshold=0)
+
+
+def test_retries_share_one_deadline() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.delay_secs = 5.0
+        started_at = time.monotonic()
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c0", "alice", "token")
+        assert time.monotonic() - started_at < 1.0
+    _run(scenario, retries=5, request_timeout_secs=10.0, total_request_timeout_secs=0.2, circuit_failure_threshold=0)
+
+
+def test_open_circuit_breaker_short_circuits_requests() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.status = 503
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c0", "alice", "token")
+        await asyncio.sleep(0.05)
+        assert len(hub.requests) == 2
+        hub.status = 200
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c1", "alice", "token")
+        assert len(hub.requests) == 2
+    _run(scenario, retries=0, circuit_failure_threshold=2, circuit_reset_timeout_secs=60.0)
+
+
+def test_first_login_after_hub_recovered_succeeds() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.status = 503
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c0", "alice", "token")
+        hub.status = 200
+        await asyncio.sleep(0.15)
+        # The circuit breaker is half open, the lookups of this login must not be rejected as concurrent trial requests
+        assert await directory_service.validate_auth("c1", "alice", "token")
+        assert len(hub.requests) == 4
+    _run(scenario, retries=0, circuit_failure_threshold=2, circuit_reset_timeout_secs=0.1)
+
+
+def test_failed_trial_request_opens_circuit_breaker_again() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.status = 503
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c0", "alice", "token")
+        await asyncio.sleep(0.15)
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.validate_auth("c1", "alice", "token")
+        assert len(hub.requests) == 3
+    _run(scenario, retries=0, circuit_failure_threshold=2, circuit_reset_timeout_secs=0.1)
+
+
+def test_server_index_refresh_survives_malformed_user_list() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        assert directory_service.server_index is not None
+        hub.bodies["/hub/api/users"] = [{"server": "10.0.0.1"}]
+        await directory_service.get_forwarding_args("c0", "alice", "token")
+        await asyncio.sleep(0.1)
+        assert len(directory_service.server_index) == 0
+        hub.bodies["/hub/api/users"] = [{"name": "alice", "server": "10.0.0.1"}]
+        await asyncio.sleep(0.1)
+        assert len(directory_service.server_index) == 1
+        address, _ = await directory_service.get_forwarding_args("c1", "alice", "token")
+        assert address == "10.0.0.1"
+    _run(scenario, server_index_token="admin-token", server_index_refresh_interval_secs=0.02)
+
+
+def test_unreachable_server_is_looked_up_at_hub() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.bodies["/hub/api/users"] = [{"name": "alice", "server": "10.0.0.1"}]
+        hub.bodies["/hub/api/users/alice"] = {"name": "alice", "server": "10.0.0.2"}
+        await directory_service.get_forwarding_args("c0", "alice", "token")
+        await asyncio.sleep(0.05)
+        address, _ = await directory_service.get_forwarding_args("c1", "alice", "token")
+        assert address == "10.0.0.1"
+        directory_service.report_unreachable("c1", "alice")
+        address, _ = await directory_service.get_forwarding_args("c2", "alice", "token")
+        assert address == "10.0.0.2"
+    _run(scenario, server_index_token="admin-token", server_index_refresh_interval_secs=60.0)
+
+
+_SPAWN_PATH = "/hub/api/users/alice/server"
+_PROGRESS_PATH = "/hub/api/users/alice/server/progress"
+_USER_PATH = "/hub/api/users/alice"
+
+
+def test_spawn_waits_for_ready_progress_event() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.events[_PROGRESS_PATH] = [{"progress": 0, "message": "Server requested"}, {"progress": 100, "ready": True}]
+        await directory_service.start_server("c0", "alice", "token")
+        assert hub.requests == [("POST", _SPAWN_PATH), ("GET", _PROGRESS_PATH)]
+    _run(scenario)
+
+
+def test_spawn_fails_on_failed_progress_event() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.events[_PROGRESS_PATH] = [{"progress": 50, "failed": True, "message": "Spawner failed"}]
+        hub.stream_hold_secs = 5.0
+        started_at = time.monotonic()
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.start_server("c0", "alice", "token")
+        assert time.monotonic() - started_at < 1.0
+        assert ("GET", _USER_PATH) not in hub.requests
+    _run(scenario)
+
+
+def test_spawn_polls_without_progress_stream() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.statuses[_PROGRESS_PATH] = 404
+        hub.bodies[_USER_PATH] = {"name": "alice", "server": "10.0.0.1", "pending": None}
+        await directory_service.start_server("c0", "alice", "token")
+        assert hub.requests == [("POST", _SPAWN_PATH), ("GET", _PROGRESS_PATH), ("GET", _USER_PATH)]
+    _run(scenario, spawn_poll_interval_secs=0.01)
+
+
+def test_spawn_polls_after_progress_stream_ended_early() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.events[_PROGRESS_PATH] = [{"progress": 50, "message": "Pulling image"}]
+        hub.bodies[_USER_PATH] = {"name": "alice", "server": "10.0.0.1", "pending": None}
+        await directory_service.start_server("c0", "alice", "token")
+        assert hub.requests == [("POST", _SPAWN_PATH), ("GET", _PROGRESS_PATH), ("GET", _USER_PATH)]
+    _run(scenario, spawn_poll_interval_secs=0.01)
+
+
+def test_spawn_polling_fails_when_server_stopped() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.statuses[_PROGRESS_PATH] = 404
+        hub.bodies[_USER_PATH] = {"name": "alice", "server": None, "pending": None}
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.start_server("c0", "alice", "token")
+    _run(scenario, spawn_poll_interval_secs=0.01)
+
+
+def test_spawn_request_and_wait_share_one_deadline() -> None:
+    async def scenario(directory_service: JupyterHubDirectoryService, hub: _Hub) -> None:
+        hub.delay_secs = 0.2
+        hub.statuses[_SPAWN_PATH] = 202
+        hub.events[_PROGRESS_PATH] = [{"progress": 0, "message": "Server requested"}]
+        hub.stream_hold_secs = 5.0
+        started_at = time.monotonic()
+        with pytest.raises(asyncssh.DisconnectError):
+            await directory_service.start_server("c0", "alice", "token")
+        assert 0.4 <= time.monotonic() - started_at < 0.65
+    _run(scenario, spawn_timeout_secs=0.5)
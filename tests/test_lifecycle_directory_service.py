@@ -0,0 +1,226 @@
+import asyncio
+from typing import Any, Optional, Tuple
+
+import pytest
+
+from better_jupyterhub_ssh.directory_service import DirectoryService
+from better_jupyterhub_ssh.lifecycle_directory_service import LifecycleDirectoryService
+
+
+class _FakeDirectoryService(DirectoryService[str]):
+    def __init__(self, stop_delay_secs: float = 0.0) -> None:
+        super().__init__()
+        self.stop_delay_secs = stop_delay_secs
+        self.fail_start = False
+        self.calls = list[Tuple[str, str]]()
+        self.running = set[str]()
+        self.stop_auth_data = list[str]()
+
+    async def validate_auth(self, connection_id: str, username: str, auth_data: str) -> bool:
+        return True
+
+    async def get_forwarding_args(self, connection_id: str, username: str, auth_data: str) -> Tuple[str, dict[str,Any]]:
+        return "127.0.0.1", {}
+
+    async def start_server(self, connection_id: str, username: str, auth_data: str) -> None:
+        self.calls.append(("start", username))
+        if self.fail_start:
+            raise RuntimeError("Failed to start container")
+        self.running.add(username)
+
+    async def stop_server(self, connection_id: str, username: str, auth_data: str) -> None:
+        self.calls.append(("stop", username))
+        self.stop_auth_data.append(auth_data)
+        await asyncio.sleep(self.stop_delay_secs)
+        self.running.discard(username)
+        self.calls.append(("stopped", username))
+
+
+def _run(idle_grace_secs: Optional[float], scenario: Any, stop_delay_secs: float = 0.0) -> None:
+    async def run() -> None:
+        directory_service = _FakeDirectoryService(stop_delay_secs)
+        await scenario(LifecycleDirectoryService(directory_service, idle_grace_secs=idle_grace_secs), directory_service)
+    asyncio.run(run())
+
+
+def test_start_is_passed_on_for_tracked_container() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.start_server("c1", "alice", "token")
+        assert service.active_sessions("alice") == 2
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+    _run(60.0, scenario)
+
+
+def test_server_stopped_externally_while_tracked() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        # Culled by the hub during the grace period
+        directory_service.running.discard("alice")
+        await service.start_server("c1", "alice", "token")
+        assert directory_service.running == {"alice"}
+        assert service.active_sessions("alice") == 1
+        await asyncio.sleep(0.1)
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+    _run(0.05, scenario)
+
+
+def test_container_is_stopped_after_grace_period() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.start_server("c1", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        await service.stop_server("c1", "alice", "token")
+        assert service.active_sessions("alice") == 0
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+        await asyncio.sleep(0.1)
+        assert directory_service.calls == [("start", "alice"), ("start", "alice"), ("stop", "alice"), ("stopped", "alice")]
+        assert directory_service.running == set()
+    _run(0.05, scenario)
+
+
+def test_login_within_grace_period_cancels_stop() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        await asyncio.sleep(0.02)
+        await service.start_server("c1", "alice", "token")
+        await asyncio.sleep(0.1)
+        assert service.active_sessions("alice") == 1
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+    _run(0.05, scenario)
+
+
+def test_container_is_stopped_immediately_without_grace_period() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        assert directory_service.calls == [("start", "alice"), ("stop", "alice"), ("stopped", "alice")]
+    _run(0.0, scenario)
+
+
+def test_start_waits_for_pending_stop() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        stopping = asyncio.ensure_future(service.stop_server("c0", "alice", "token"))
+        await asyncio.sleep(0.01)
+        await service.start_server("c1", "alice", "token")
+        assert directory_service.calls == [("start", "alice"), ("stop", "alice"), ("stopped", "alice"), ("start", "alice")]
+        await stopping
+    _run(0.0, scenario, stop_delay_secs=0.05)
+
+
+def test_failed_start_does_not_count_session() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        directory_service.fail_start = True
+        with pytest.raises(RuntimeError):
+            await service.start_server("c0", "alice", "token")
+        assert service.active_sessions("alice") == 0
+        directory_service.fail_start = False
+        await service.start_server("c1", "alice", "token")
+        assert service.active_sessions("alice") == 1
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+    _run(60.0, scenario)
+
+
+def test_container_is_left_running_without_idle_stops() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        assert service.active_sessions("alice") == 0
+        # Not known to be running anymore, so the next login asks the hub again
+        await service.start_server("c1", "alice", "token")
+        assert directory_service.calls == [("start", "alice"), ("start", "alice")]
+    _run(None, scenario)
+
+
+def test_suspended_idle_stops_cancel_pending_stops() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.start_server("c1", "bob", "token")
+        await service.stop_server("c0", "alice", "token")
+        service.suspend_idle_stops()
+        await service.stop_server("c1", "bob", "token")
+        await asyncio.sleep(0.1)
+        assert directory_service.calls == [("start", "alice"), ("start", "bob")]
+    _run(0.05, scenario)
+
+
+def test_finalize_cancels_pending_stops() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        await service.finalize()
+        await asyncio.sleep(0.1)
+        assert directory_service.calls == [("start", "alice")]
+    _run(0.05, scenario)
+
+
+def test_failed_start_within_grace_period_keeps_pending_stop() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        directory_service.fail_start = True
+        with pytest.raises(RuntimeError):
+            await service.start_server("c1", "alice", "wrong-token")
+        assert service.active_sessions("alice") == 0
+        await asyncio.sleep(0.1)
+        assert directory_service.calls == [("start", "alice"), ("start", "alice"), ("stop", "alice"), ("stopped", "alice")]
+        assert directory_service.running == set()
+    _run(0.05, scenario)
+
+
+def test_concurrent_failed_starts_within_grace_period_keep_pending_stop() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        directory_service.fail_start = True
+        results = await asyncio.gather(
+            service.start_server("c1", "alice", "wrong-token"),
+            service.start_server("c2", "alice", "wrong-token"),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        await asyncio.sleep(0.1)
+        assert directory_service.running == set()
+    _run(0.05, scenario)
+
+
+def test_resumed_idle_stops_stop_containers_in_use_afterwards() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        service.suspend_idle_stops()
+        await service.start_server("c0", "alice", "token")
+        await service.start_server("c1", "bob", "token")
+        await service.stop_server("c0", "alice", "token")
+        service.resume_idle_stops(0.05)
+        await service.stop_server("c1", "bob", "token")
+        await asyncio.sleep(0.1)
+        assert directory_service.running == {"alice"}
+    _run(0.05, scenario)
+
+
+def test_released_start_keeps_pending_stop() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.stop_server("c0", "alice", "token")
+        await asyncio.sleep(0.12)
+        # Succeeds without validating the credentials, e.g. for a container found in the server index
+        await service.start_server("c1", "alice", "wrong-token")
+        await service.release_server("c1", "alice", "wrong-token")
+        assert service.active_sessions("alice") == 0
+        await asyncio.sleep(0.12)
+        assert directory_service.stop_auth_data == ["token"]
+        assert directory_service.running == set()
+    _run(0.2, scenario)
+
+
+def test_released_start_with_other_sessions_keeps_container() -> None:
+    async def scenario(service: LifecycleDirectoryService[str], directory_service: _FakeDirectoryService) -> None:
+        await service.start_server("c0", "alice", "token")
+        await service.start_server("c1", "alice", "wrong-token")
+        await service.release_server("c1", "alice", "wrong-token")
+        assert service.active_sessions("alice") == 1
+        await asyncio.sleep(0.1)
+        assert directory_service.running == {"alice"}
+    _run(0.05, scenario)
@@ -0,0 +1,91 @@
+import os
+import time
+from typing import Any, Optional
+
+import asyncssh
+import asyncssh.compression
+import asyncssh.connection
+import asyncssh.encryption
+from asyncssh.packet import Byte, String, UInt32
+import pytest
+
+from better_jupyterhub_ssh.proxy_server import _send_payload
+
+
+class _Connection:
+    # Just the state used by SSHConnection.send_packet, with the keys already exchanged
+    send_packet = asyncssh.connection.SSHConnection.send_packet
+
+    def __init__(self, enc_alg: Optional[bytes], mac_alg: bytes, compression_alg: Optional[bytes], rekey_bytes: int) -> None:
+        super().__init__()
+        self._auth_complete = True
+        self._auth_in_progress = False
+        self._kex_complete = True
+        self._kexinit_sent = False
+        self._deferred_packets = list[Any]()
+        self._rekey_bytes = rekey_bytes
+        self._rekey_bytes_sent = 0
+        self._rekey_seconds = 3600.0
+        self._rekey_time = time.monotonic() + 3600.0
+        self._send_seq = 0xfffffffe
+        self._send_encryption: Optional[asyncssh.encryption.Encryption] = None
+        self._send_enchdrlen = 5
+        self._send_blocksize = 8
+        if enc_alg is not None:
+            enc_keysize, enc_ivsize, enc_blocksize, mac_keysize, _, etm = asyncssh.encryption.get_encryption_params(enc_alg, mac_alg)
+            self._send_encryption = asyncssh.encryption.get_encryption(enc_alg, b"\x01" * enc_keysize, b"\x02" * enc_ivsize, mac_alg, b"\x03" * mac_keysize, etm)
+            self._send_enchdrlen = 1 if etm else 5
+            self._send_blocksize = max(8, enc_blocksize)
+        self._compressor = asyncssh.compression.get_compressor(compression_alg) if compression_alg is not None else None
+        self._compress_after_auth = False
+        self.sent = list[bytes]()
+        self.kexinit_count = 0
+
+    def _send(self, data: bytes) -> None:
+        self.sent.append(data)
+
+    def _send_kexinit(self) -> None:
+        self.kexinit_count += 1
+
+    def log_sent_packet(self, pkt_type: int, seq: int, payload: bytes) -> None:
+        pass
+
+
+def _channel_data(data: bytes) -> bytes:
+    return Byte(asyncssh.MSG_CHANNEL_DATA) + UInt32(0) + String(data)
+
+
+_PAYLOADS = [
+    _channel_data(b""),
+    _channel_data(b"x" * 100),
+    Byte(asyncssh.MSG_IGNORE) + String(b"ignored"),
+    _channel_data(os.urandom(5000)),
+    Byte(asyncssh.MSG_GLOBAL_REQUEST) + String(b"keepalive@openssh.com") + Byte(1),
+    _channel_data(b"y" * 33),
+]
+
+
+@pytest.mark.parametrize("enc_alg,mac_alg,compression_alg,rekey_bytes", [
+    (None, b"", None, 1 << 30),
+    (None, b"", b"zlib@openssh.com", 1 << 30),
+    (b"chacha20-poly1305@openssh.com", b"", None, 1 << 30),
+    (b"aes128-gcm@openssh.com", b"", None, 1 << 30),
+    (b"aes128-ctr", b"hmac-sha2-256", None, 1 << 30),
+    (b"aes128-ctr", b"hmac-sha2-256-etm@openssh.com", None, 1 << 30),
+    (b"chacha20-poly1305@openssh.com", b"", b"zlib@openssh.com", 1 << 30),
+    # Falls back to send_packet, which starts a key exchange, once the rekey limit was reached
+    (b"chacha20-poly1305@openssh.com", b"", None, 200),
+])
+def test_sends_same_bytes_as_send_packet(monkeypatch: pytest.MonkeyPatch, enc_alg: Optional[bytes], mac_alg: bytes, compression_alg: Optional[bytes], rekey_bytes: int) -> None:
+    monkeypatch.setattr(os, "urandom", lambda size: bytes(range(size)))
+    expected = _Connection(enc_alg, mac_alg, compression_alg, rekey_bytes)
+    actual = _Connection(enc_alg, mac_alg, compression_alg, rekey_bytes)
+    for payload in _PAYLOADS:
+        expected.send_packet(payload[0], payload[1:])
+        _send_payload(actual, payload[0], payload)  # type: ignore
+        assert actual.sent == expected.sent
+        assert actual._send_seq == expected._send_seq
+        assert actual._rekey_bytes_sent == expected._rekey_bytes_sent
+        assert actual.kexinit_count == expected.kexinit_count
+    if rekey_bytes < 1 << 30:
+        assert actual.kexinit_count > 0
@@ -0,0 +1,62 @@
+import time
+
+from better_jupyterhub_ssh.server_index import ServerIndex
+
+
+def test_lookups_count_hits_and_misses() -> None:
+    server_index = ServerIndex()
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}, {"name": "bob", "server": None, "pending": "spawn"}], time.monotonic())
+    alice = server_index.get("alice")
+    assert alice is not None and alice.ready and alice.address == "10.0.0.1"
+    bob = server_index.get("bob")
+    assert bob is not None and not bob.ready and bob.pending == "spawn"
+    assert server_index.get("carol") is None
+    assert (server_index.hits, server_index.misses) == (2, 1)
+    assert len(server_index) == 2
+
+
+def test_ready_flag_of_named_default_server() -> None:
+    server_index = ServerIndex()
+    server_index.replace([{"name": "alice", "server": None, "servers": {"": {"ready": True}}}], time.monotonic())
+    alice = server_index.get("alice")
+    assert alice is not None and alice.ready
+
+
+def test_stale_index_is_not_used() -> None:
+    server_index = ServerIndex(max_age_secs=0.05)
+    assert not server_index.fresh
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}], time.monotonic())
+    assert server_index.fresh
+    assert server_index.get("alice") is not None
+    time.sleep(0.06)
+    assert not server_index.fresh
+    assert server_index.get("alice") is None
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}], time.monotonic())
+    assert server_index.get("alice") is not None
+
+
+def test_replace_drops_users_missing_from_listing() -> None:
+    server_index = ServerIndex()
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}], time.monotonic())
+    server_index.replace([], time.monotonic())
+    assert server_index.get("alice") is None
+
+
+def test_invalidate_removes_entry() -> None:
+    server_index = ServerIndex()
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}], time.monotonic())
+    server_index.invalidate("alice")
+    assert server_index.get("alice") is None
+
+
+def test_invalidate_wins_over_replace_in_flight() -> None:
+    server_index = ServerIndex()
+    started_at = time.monotonic()
+    # The user changed locally while the listing was requested, so the listed state is outdated
+    server_index.invalidate("alice")
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}, {"name": "bob", "server": "10.0.0.2"}], started_at)
+    assert server_index.get("alice") is None
+    assert server_index.get("bob") is not None
+    # Listings started after the invalidation are used again
+    server_index.replace([{"name": "alice", "server": "10.0.0.1"}], time.monotonic())
+    assert server_index.get("alice") is not None
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from better_jupyterhub_ssh.single_flight import SingleFlight
+
+
+def test_concurrent_calls_are_coalesced() -> None:
+    async def scenario() -> None:
+        single_flight = SingleFlight[str, int]()
+        calls = list[str]()
+        async def factory() -> int:
+            calls.append("call")
+            await asyncio.sleep(0.01)
+            return len(calls)
+        results = await asyncio.gather(*(single_flight.run("alice", factory) for _ in range(5)))
+        assert results == [1] * 5
+        assert calls == ["call"]
+        assert len(single_flight) == 0
+        assert await single_flight.run("alice", factory) == 2
+    asyncio.run(scenario())
+
+
+def test_different_keys_are_not_coalesced() -> None:
+    async def scenario() -> None:
+        single_flight = SingleFlight[str, str]()
+        async def factory(value: str) -> str:
+            await asyncio.sleep(0.01)
+            return value
+        results = await asyncio.gather(single_flight.run("alice", lambda: factory("a")), single_flight.run("bob", lambda: factory("b")))
+        assert results == ["a", "b"]
+    asyncio.run(scenario())
+
+
+def test_exception_is_raised_for_all_waiters() -> None:
+    async def scenario() -> None:
+        single_flight = SingleFlight[str, None]()
+        async def factory() -> None:
+            await asyncio.sleep(0.01)
+            raise RuntimeError("Failed to start container")
+        results = await asyncio.gather(*(single_flight.run("alice", factory) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert len(single_flight) == 0
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_call() -> None:
+    async def scenario() -> None:
+        single_flight = SingleFlight[str, str]()
+        async def factory() -> str:
+            await asyncio.sleep(0.05)
+            return "done"
+        cancelled = asyncio.ensure_future(single_flight.run("alice", factory))
+        waiting = asyncio.ensure_future(single_flight.run("alice", factory))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert await waiting == "done"
+    asyncio.run(scenario())